@@ -0,0 +1,365 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "cchdo-auth==1.0.2",
+#     "cchdo-hydro[netcdf]==1.0.2.15",
+#     "rich",
+# ]
+# ///
+"""Run the trackline, sumfile and both derived file robots in one process.
+
+All the work is planned up front from a single metadata load, then every CF
+file is downloaded and opened once and all the tasks that need it are run.
+
+With --watch it keeps running, polling the catalogue and running the work of
+the cruises that changed since the last poll with the imports, connections
+and caches already warm.
+"""
+import argparse
+import json
+import logging
+import signal
+import sys
+import threading
+from concurrent.futures import Future
+from hashlib import sha256
+from pathlib import Path
+
+from rich.console import Console
+
+from cchdo.auth.session import session as s
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from robots_common import metadata  # noqa: E402
+from robots_common.api import api_for, succeeded  # noqa: E402
+from robots_common.catalogue import load_catalogue  # noqa: E402
+from robots_common.cf_cache import cf_cache  # noqa: E402
+from robots_common.datasets import load_cf  # noqa: E402
+from robots_common.gha import GHAGroup, close_install_group  # noqa: E402
+from robots_common.instrument import labelled, recorder, run_report  # noqa: E402
+from robots_common.journal import Journal  # noqa: E402
+from robots_common.logs import setup_logging  # noqa: E402
+from robots_common.shard import add_shard_arguments, describe, select_shard  # noqa: E402
+from robots_common.state import RunState  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+console = Console(color_system="256")
+
+setup_logging(console, level="DEBUG")
+
+# imported after the logging setup above so theirs does not take effect
+import trackline.__main__ as trackline  # noqa: E402
+import sumfile_update.__main__ as sumfile_update  # noqa: E402
+import controlled_file_generator.__main__ as cfg  # noqa: E402
+
+DERIVED_DTYPES = ("bottle", "ctd")
+
+# the standalone trackline robot only logs failures, it never exits non zero
+EXIT_CODE_ROBOTS = ("sumfile", *DERIVED_DTYPES)
+
+
+def plan(catalogue, state, failed, track_options, journals):
+    """Plan the work of every robot, grouped by the CF file it needs
+
+    Returns a dict of CF file_hash to (cf_file, tasks) where each task is
+    (robot, expocode, dataset tasks, callable taking the loaded dataset and
+    returning the future of its uploads).
+    """
+    work_by_cf = {}
+
+    def add(cf_file, robot, expocode, dataset_tasks, run):
+        _, tasks = work_by_cf.setdefault(cf_file["file_hash"], (cf_file, []))
+        tasks.append((robot, expocode, dataset_tasks, run))
+
+    with GHAGroup("Find cruises that need a trackline"):
+        track_work, track_cannot_do = trackline.plan_tracks(catalogue, state)
+    for cruise, cf_file in track_work:
+        add(
+            cf_file,
+            "trackline",
+            cruise["expocode"],
+            ["track"],
+            lambda df, cruise=cruise, cf_file=cf_file: trackline.add_track(
+                cruise, cf_file, df, state, **track_options
+            ),
+        )
+
+    with GHAGroup("Find cruises that need a sumfile"):
+        sum_work, sum_cannot_do = sumfile_update.plan_sumfiles(catalogue, state)
+    sumfile_update.report_cannot_do(sum_work, sum_cannot_do)
+    for cruise, cf_file in sum_work:
+        add(
+            cf_file,
+            "sumfile",
+            cruise["expocode"],
+            ["summary"],
+            lambda df, cruise=cruise, cf_file=cf_file: sumfile_update.add_sumfile(
+                cruise, cf_file, df, catalogue, state, journals["sumfile"]
+            ),
+        )
+
+    for dtype in DERIVED_DTYPES:
+        logger.info(f"Checking files for data type: {dtype}")
+        cfg.dirty = False
+        cruise_work = cfg.plan_derived(dtype, catalogue, state, journals[dtype])
+        failed[dtype] = cfg.dirty
+        for expocode, kwargs in cruise_work:
+            add(
+                kwargs["cf_file"],
+                dtype,
+                expocode,
+                sorted(set(kwargs["files_need_replacing"].values())),
+                lambda df, kwargs=kwargs: cfg.process_single_cruise(**kwargs, df=df),
+            )
+
+    if len(track_cannot_do) > 0:
+        logger.info(f"Could not generate track for {len(track_cannot_do)} cruises")
+
+    return work_by_cf
+
+
+def open_journals(shard=None) -> dict[str, Journal]:
+    # trackline's single PATCH can simply be made again, it has no journal
+    return {
+        robot: Journal(robot, shard=shard) for robot in ("sumfile", *DERIVED_DTYPES)
+    }
+
+
+def resume_unfinished(journals, state):
+    if not any(len(journal.unfinished()) > 0 for journal in journals.values()):
+        return
+    # the changes the earlier run did make have to be seen
+    metadata.invalidate()
+    with GHAGroup("Resume unfinished cruises"):
+        catalogue = load_catalogue(s)
+        sumfile_update.resume_unfinished(journals["sumfile"], catalogue, state)
+        for dtype in DERIVED_DTYPES:
+            cfg.resume_unfinished(journals[dtype], dtype, catalogue)
+        metadata.invalidate()
+
+
+def dispatch(work_by_cf, failed, stop=None) -> list[tuple[str, str, Future]]:
+    """Run the planned tasks and wait for their uploads
+
+    Returns the (robot, expocode, future) of each task run. If stop is set no
+    more CF files are started.
+    """
+    # the uploads of each task overlap with the tasks that come after it
+    uploads = []
+    for cf_file, tasks in work_by_cf.values():
+        if stop is not None and stop.is_set():
+            logger.info("Stopping, the remaining cruises are left for later")
+            break
+        # a failed sumfile upload stops the sumfile robot, like it does standalone
+        failed["sumfile"] = failed["sumfile"] or any(
+            robot == "sumfile" and future.done() and not succeeded(future)
+            for robot, _, future in uploads
+        )
+        tasks = [task for task in tasks if task[0] != "sumfile" or not failed["sumfile"]]
+        if len(tasks) == 0:
+            continue
+
+        dataset_tasks = {name for _, _, names, _ in tasks for name in names}
+        try:
+            with labelled(tasks[0][1]):
+                df = load_cf(cf_cache.fetch(s, cf_file), tasks=dataset_tasks)
+            for robot, expocode, _, run in tasks:
+                with GHAGroup(
+                    f"Running {robot} robot for cruise {expocode}", robot, expocode
+                ):
+                    uploads.append((robot, expocode, run(df)))
+        except Exception:
+            # one bad CF file should not stop the others
+            logger.exception(f"Could not run the tasks of {cf_file['file_name']}")
+            for robot, *_ in tasks:
+                failed[robot] = True
+
+    api_for(s).wait()
+    for robot, _, future in uploads:
+        if not succeeded(future):
+            failed[robot] = True
+    return uploads
+
+
+def finish(journals, state, n_tasks):
+    for journal in journals.values():
+        journal.compact()
+    trackline.report_simplification()
+    if n_tasks > 0:
+        metadata.invalidate()
+    state.save()
+
+
+def run_all(full=False, track_options=None, shard=None, shard_by="expocode"):
+    failed = {robot: False for robot in ("trackline", "sumfile", *DERIVED_DTYPES)}
+    state = RunState(full=full)
+    journals = open_journals(shard)
+    resume_unfinished(journals, state)
+
+    with GHAGroup("Load cruise and file metadata"):
+        logger.info("Loading Cruise and File information")
+        catalogue = load_catalogue(s)
+
+    work_by_cf = plan(catalogue, state, failed, track_options or {}, journals)
+    if shard is not None:
+        # the tasks of a CF file are all for the cruise it belongs to
+        work_by_cf = dict(
+            select_shard(
+                work_by_cf.items(),
+                shard,
+                expocode=lambda item: item[1][1][0][1],
+                size=lambda item: item[1][0].get("file_size") or 0,
+                by=shard_by,
+            )
+        )
+        logger.info(f"{len(work_by_cf)} CF files are in {describe(shard)}")
+    n_tasks = sum(len(tasks) for _, tasks in work_by_cf.values())
+    logger.info(f"Planned {n_tasks} tasks using {len(work_by_cf)} CF files")
+
+    dispatch(work_by_cf, failed)
+    finish(journals, state, n_tasks)
+
+    for robot, robot_failed in failed.items():
+        logger.info(f"{robot}: {'errors' if robot_failed else 'ok'}")
+
+    return any(failed[robot] for robot in EXIT_CODE_ROBOTS)
+
+
+def snapshot(catalogue) -> dict[str, str]:
+    """A digest of each cruise and the records of its files, by expocode"""
+    digests = {}
+    for cruise in catalogue.cruises:
+        files = [
+            catalogue.file_by_id[file_id].as_dict()
+            for file_id in cruise["files"]
+            if file_id in catalogue.file_by_id
+        ]
+        record = json.dumps([cruise, files], sort_keys=True, default=str)
+        digests[cruise["expocode"]] = sha256(record.encode("utf8")).hexdigest()
+    return digests
+
+
+def watch(interval, full=False, track_options=None, batch=None):
+    """Poll the catalogue every interval seconds and run the work of cruises that changed
+
+    Cruises whose tasks failed or were not reached are tried again in the next
+    cycle. At most batch CF files are opened per cycle, with more left the next
+    cycle starts straight away. SIGINT or SIGTERM stop the run after the
+    current CF file once its uploads are done.
+    """
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    state = RunState(full=full)
+    journals = open_journals()
+    resume_unfinished(journals, state)
+
+    previous = {}
+    retry = set()
+    while not stop.is_set():
+        backlog = False
+        recorder.reset()
+        try:
+            # max_age=0 makes it a conditional request every time
+            catalogue = load_catalogue(s, max_age=0)
+            current = snapshot(catalogue)
+            todo = retry | {e for e, d in current.items() if previous.get(e) != d}
+            if len(todo) > 0:
+                retry, backlog = watch_cycle(
+                    catalogue, state, journals, todo, track_options, batch, stop
+                )
+            # only once the cycle is done, so a failed one is tried again
+            previous = current
+        except Exception:
+            logger.exception("Watch cycle failed, trying again after the interval")
+        if not backlog:
+            stop.wait(interval)
+    logger.info("Stopped watching")
+
+
+def watch_cycle(catalogue, state, journals, todo, track_options, batch, stop):
+    """Run the planned work of the cruises in todo
+
+    Returns the expocodes to try again next cycle and whether any were left
+    out because of batch.
+    """
+    failed = {robot: False for robot in ("trackline", "sumfile", *DERIVED_DTYPES)}
+    work_by_cf = {
+        file_hash: (cf_file, tasks)
+        for file_hash, (cf_file, tasks) in plan(
+            catalogue, state, failed, track_options or {}, journals
+        ).items()
+        if tasks[0][1] in todo
+    }
+    if len(work_by_cf) == 0:
+        # e.g. the changes were the last cycle's own uploads
+        state.save()
+        return set(), False
+
+    planned = {tasks[0][1] for _, tasks in work_by_cf.values()}
+    backlog = batch is not None and len(work_by_cf) > batch
+    if backlog:
+        work_by_cf = dict(list(work_by_cf.items())[:batch])
+    n_tasks = sum(len(tasks) for _, tasks in work_by_cf.values())
+    logger.info(
+        f"{len(todo)} cruises changed, running {n_tasks} tasks using {len(work_by_cf)} CF files"
+    )
+    with run_report("all") as outcome:
+        try:
+            uploads = dispatch(work_by_cf, failed, stop)
+        finally:
+            finish(journals, state, n_tasks)
+        outcome["failed"] = any(failed[robot] for robot in EXIT_CODE_ROBOTS)
+
+    done = {expocode for _, expocode, _ in uploads}
+    not_ok = {
+        expocode
+        for _, expocode, future in uploads
+        if future.exception() is not None or not future.result()
+    }
+    return (planned - done) | not_ok, backlog
+
+
+if __name__ == "__main__":
+    close_install_group()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="check every controlled cruise, not only those changed since the last run",
+    )
+    parser.add_argument(
+        "--watch",
+        type=float,
+        metavar="SECONDS",
+        help="keep running, polling the catalogue for changes this often",
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        metavar="N",
+        help="with --watch, open at most N CF files per poll",
+    )
+    trackline.add_simplify_arguments(parser)
+    add_shard_arguments(parser)
+    args = parser.parse_args()
+    if args.watch is not None and args.shard is not None:
+        parser.error("--watch cannot be used with --shard")
+    track_options = dict(
+        tolerance=args.track_tolerance, max_vertices=args.track_max_vertices
+    )
+    if args.watch is not None:
+        watch(args.watch, full=args.full, track_options=track_options, batch=args.batch)
+        exit(0)
+    with run_report("all", shard=args.shard) as outcome:
+        failed = run_all(
+            full=args.full,
+            track_options=track_options,
+            shard=args.shard,
+            shard_by=args.shard_by,
+        )
+        outcome["failed"] = failed
+    if failed:
+        exit(1)
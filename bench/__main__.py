@@ -0,0 +1,150 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "cchdo-auth==1.0.2",
+#     "cchdo-hydro[netcdf]==1.0.2.15",
+#     "rich",
+# ]
+# ///
+"""Run the robots against a local mock CCHDO API and report their throughput.
+
+Each robot gets a freshly seeded mock server and (unless --warm) an empty
+cache directory, it is run as its own process the same way the workflows do
+and timed from start to exit.
+"""
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from rich.console import Console
+from rich.table import Table
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO))
+from bench.mock_server import MockCCHDO, seed  # noqa: E402
+
+ROBOTS = {
+    "trackline": ["trackline/__main__.py"],
+    "sumfile": ["sumfile_update/__main__.py"],
+    "bottle": ["controlled_file_generator/__main__.py", "bottle"],
+    "ctd": ["controlled_file_generator/__main__.py", "ctd"],
+    "all": ["all_robots/__main__.py"],
+}
+
+
+def run_robot(name, argv, api, cache_dir, log_dir) -> dict:
+    server = api.serve()
+    env = {
+        **os.environ,
+        "CCHDO_URL": f"http://127.0.0.1:{server.server_port}",
+        "CCHDO_ROBOTS_CACHE": str(cache_dir),
+    }
+    env.pop("GITHUB_RUN_ID", None)
+
+    with open(log_dir / f"{name}.log", "w") as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, *argv], cwd=REPO, env=env, stdout=log, stderr=log
+        )
+        # wait4 gives the resource usage of just this child
+        _, status, rusage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    server.shutdown()
+
+    cruises = len(api.touched_cruises)
+    return {
+        "robot": name,
+        "exit_code": proc.returncode,
+        "seconds": elapsed,
+        "cruises": cruises,
+        "cruises_per_second": cruises / elapsed,
+        "requests": api.stats["requests"],
+        "bytes_in": api.stats["bytes_in"],
+        "bytes_out": api.stats["bytes_out"],
+        # ru_maxrss is in KiB on linux
+        "peak_rss": rusage.ru_maxrss * 1024,
+    }
+
+
+def report(results):
+    table = Table(title="Robot throughput against the mock CCHDO API")
+    for column in (
+        "robot",
+        "exit",
+        "seconds",
+        "cruises",
+        "cruises/s",
+        "requests",
+        "MiB uploaded",
+        "MiB downloaded",
+        "peak RSS MiB",
+    ):
+        table.add_column(column, justify="left" if column == "robot" else "right")
+    for r in results:
+        table.add_row(
+            r["robot"],
+            str(r["exit_code"]),
+            f"{r['seconds']:.2f}",
+            str(r["cruises"]),
+            f"{r['cruises_per_second']:.2f}",
+            str(r["requests"]),
+            f"{r['bytes_in'] / 1024**2:.2f}",
+            f"{r['bytes_out'] / 1024**2:.2f}",
+            f"{r['peak_rss'] / 1024**2:.0f}",
+        )
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--robots",
+        nargs="+",
+        choices=list(ROBOTS),
+        default=["trackline", "sumfile", "bottle", "ctd"],
+    )
+    parser.add_argument("--cruises", type=int, default=10)
+    parser.add_argument("--profiles", type=int, default=20, help="stations per cruise")
+    parser.add_argument("--levels", type=int, default=36, help="samples per station")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every request"
+    )
+    parser.add_argument(
+        "--robot-args", default="", help='extra robot arguments, e.g. "--workers 2"'
+    )
+    parser.add_argument(
+        "--warm", action="store_true", help="share one cache directory between robots"
+    )
+    parser.add_argument("--json", type=Path, help="also write the results here")
+    parser.add_argument(
+        "--log-dir", type=Path, help="keep robot output here instead of a temp dir"
+    )
+    args = parser.parse_args()
+
+    print(f"Generating {args.cruises} synthetic cruises")
+    cf_files = seed(MockCCHDO(), args.cruises, args.profiles, args.levels)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        log_dir = args.log_dir or Path(tmp)
+        log_dir.mkdir(parents=True, exist_ok=True)
+        for name in args.robots:
+            api = MockCCHDO(latency=args.latency)
+            seed(api, args.cruises, args.profiles, args.levels, cf_files=cf_files)
+            cache_dir = Path(tmp) / ("cache" if args.warm else f"cache-{name}")
+            argv = [*ROBOTS[name]]
+            if name not in ("trackline", "sumfile"):
+                argv += shlex.split(args.robot_args)
+            print(f"Running {name}")
+            results.append(run_robot(name, argv, api, cache_dir, log_dir))
+
+    report(results)
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2))
@@ -0,0 +1,309 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "cchdo-hydro[netcdf]==1.0.2.15",
+# ]
+# ///
+"""A local stand in for the parts of the CCHDO API the robots use.
+
+Serves cruise/all and file/all (with ETags), file GET/POST/PATCH, the file
+reactivate POST, cruise PATCH and the cruise file attach POST, plus the file
+downloads themselves. Every response can be delayed by a fixed latency and
+the server keeps counts of requests and bytes so runs can be compared.
+
+Run it directly to get a seeded server to point a robot at with CCHDO_URL.
+"""
+
+import argparse
+import io
+import json
+import re
+import tempfile
+import threading
+import time
+from base64 import b64decode
+from collections import Counter
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+class MockCCHDO:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.cruises: dict[int, dict] = {}
+        self.files: dict[int, dict] = {}
+        self.blobs: dict[str, bytes] = {}
+        self.stats = Counter()
+        self.touched_cruises: set[int] = set()
+        self.version = 0
+        self.lock = threading.RLock()
+
+    def add_cruise(self, cruise: dict):
+        with self.lock:
+            self.cruises[cruise["id"]] = cruise
+            self.version += 1
+
+    def add_file(self, record: dict, data: bytes, cruise_id: int | None = None):
+        with self.lock:
+            record = {
+                "file_sources": [],
+                "cruises": [],
+                "role": "dataset",
+                "events": [],
+                **record,
+            }
+            record["id"] = record.get("id") or max(self.files, default=0) + 1
+            record["file_hash"] = sha256(data).hexdigest()
+            record["file_size"] = len(data)
+            record["file_path"] = f"/data/{record['id']}/{record['file_name']}"
+            self.files[record["id"]] = record
+            self.blobs[record["file_path"]] = data
+            if cruise_id is not None:
+                self._attach(cruise_id, record["id"])
+            self.version += 1
+            return record
+
+    def _attach(self, cruise_id: int, file_id: int):
+        cruise = self.cruises[cruise_id]
+        file = self.files[file_id]
+        if file_id not in cruise["files"]:
+            cruise["files"].append(file_id)
+        if cruise_id not in file["cruises"]:
+            file["cruises"].append(cruise_id)
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats.clear()
+            self.touched_cruises.clear()
+
+    def serve(self, host="127.0.0.1", port=0) -> ThreadingHTTPServer:
+        """Start serving on a background thread, port 0 picks a free port"""
+        server = ThreadingHTTPServer((host, port), _make_handler(self))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def apply_patch(doc: dict, patch: list[dict]):
+    """The subset of JSON Patch (RFC 6902) the robots send: add and replace"""
+    for op in patch:
+        *parents, last = op["path"].lstrip("/").split("/")
+        target = doc
+        for key in parents:
+            target = target[int(key)] if isinstance(target, list) else target[key]
+        if isinstance(target, list):
+            if op["op"] == "add":
+                target.insert(int(last), op["value"])
+            else:
+                target[int(last)] = op["value"]
+        else:
+            target[last] = op["value"]
+
+
+def _make_handler(api: MockCCHDO):
+    all_docs = {
+        "/api/v1/cruise/all": lambda: list(api.cruises.values()),
+        "/api/v1/file/all": lambda: list(api.files.values()),
+    }
+    file_re = re.compile(r"^/api/v1/file/(\d+)$")
+    cruise_re = re.compile(r"^/api/v1/cruise/(\d+)$")
+    attach_re = re.compile(r"^/api/v1/cruise/(\d+)/files/(\d+)$")
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length", 0))
+            data = self.rfile.read(length)
+            api.count("bytes_in", length)
+            return json.loads(data) if data else None
+
+        def _send(self, status, body=b"", headers=None):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode("utf8")
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            api.count("bytes_out", len(body))
+
+        def _start(self):
+            api.count("requests")
+            api.count(f"requests_{self.command}")
+            if api.latency:
+                time.sleep(api.latency)
+
+        def do_GET(self):
+            self._start()
+            # build the response under the lock but send it outside so slow
+            # downloads do not hold up other requests
+            with api.lock:
+                response = self._get()
+            self._send(*response)
+
+        def _get(self):
+            if self.path in all_docs:
+                etag = f'"{api.version}"'
+                if self.headers.get("If-None-Match") == etag:
+                    return 304, b"", {"ETag": etag}
+                body = json.dumps(all_docs[self.path]()).encode("utf8")
+                return 200, body, {"ETag": etag}
+            if (m := file_re.match(self.path)) is not None:
+                if (file := api.files.get(int(m[1]))) is not None:
+                    return 200, json.dumps(file).encode("utf8")
+            elif (blob := api.blobs.get(self.path)) is not None:
+                return 200, blob
+            return 404, {"message": "not found"}
+
+        def do_POST(self):
+            self._start()
+            body = self._body()
+            with api.lock:
+                if self.path == "/api/v1/file":
+                    upload = body.pop("file")
+                    data = b64decode(upload["body"])
+                    if sha256(data).hexdigest() != body["file_hash"]:
+                        return self._send(400, {"message": "hash mismatch"})
+                    record = api.add_file(body, data)
+                    return self._send(201, {"message": f"/api/v1/file/{record['id']}"})
+                if (m := attach_re.match(self.path)) is not None:
+                    cruise_id, file_id = int(m[1]), int(m[2])
+                    if cruise_id not in api.cruises or file_id not in api.files:
+                        return self._send(404, {"message": "not found"})
+                    api._attach(cruise_id, file_id)
+                    api.touched_cruises.add(cruise_id)
+                    api.version += 1
+                    return self._send(200, {"message": "attached"})
+                if (m := file_re.match(self.path)) is not None:
+                    if int(m[1]) not in api.files:
+                        return self._send(404, {"message": "not found"})
+                    # reactivation
+                    api.version += 1
+                    return self._send(200, {"message": "ok"})
+            self._send(404, {"message": "not found"})
+
+        def do_PATCH(self):
+            self._start()
+            body = self._body()
+            with api.lock:
+                if (m := file_re.match(self.path)) is not None:
+                    if (file := api.files.get(int(m[1]))) is None:
+                        return self._send(404, {"message": "not found"})
+                    apply_patch(file, body)
+                    api.touched_cruises.update(file["cruises"])
+                    api.version += 1
+                    return self._send(200, file)
+                if (m := cruise_re.match(self.path)) is not None:
+                    if (cruise := api.cruises.get(int(m[1]))) is None:
+                        return self._send(404, {"message": "not found"})
+                    apply_patch(cruise, body)
+                    api.touched_cruises.add(cruise["id"])
+                    api.version += 1
+                    return self._send(200, cruise)
+            self._send(404, {"message": "not found"})
+
+    return Handler
+
+
+def synthetic_cf(expocode: str, dtype: str, profiles: int, levels: int) -> bytes:
+    """A CF netCDF file with profiles stations of levels samples each"""
+    from cchdo.hydro.exchange import read_csv
+
+    params = ["CTDPRS [DBAR]", "CTDTMP [ITS-90]", "CTDSAL [PSS-78]", "CTDOXY [UMOL/KG]"]
+    if dtype == "bottle":
+        params += ["SALNTY [PSS-78]", "OXYGEN [UMOL/KG]", "SILCAT [UMOL/KG]"]
+    header = "EXPOCODE,STNNBR,CASTNO,SAMPNO,DATE,TIME,LATITUDE,LONGITUDE," + ",".join(
+        params
+    )
+    rows = [header]
+    for station in range(profiles):
+        # a section heading east that crosses the dateline
+        lat = -60 + 0.5 * station
+        lon = (170 + 0.5 * station + 180) % 360 - 180
+        for level in range(levels):
+            values = [f"{2.0 * level + 1:.1f}", f"{20 - 0.01 * level:.4f}"]
+            values += [f"{34.5 + 0.001 * level:.4f}", f"{250 - 0.1 * level:.1f}"]
+            if dtype == "bottle":
+                values += [f"{34.5:.4f}", f"{251.0:.1f}", f"{10 + 0.1 * level:.2f}"]
+            rows.append(
+                f"{expocode},{station + 1},1,{level + 1},20200101,1200,"
+                f"{lat:.4f},{lon:.4f}," + ",".join(values)
+            )
+    ds = read_csv(
+        io.BytesIO("\n".join(rows).encode("ascii")),
+        ftype="B" if dtype == "bottle" else "C",
+    )
+    with tempfile.NamedTemporaryFile(suffix=".nc") as tf:
+        ds.to_netcdf(tf.name, engine="netcdf4")
+        return Path(tf.name).read_bytes()
+
+
+def seed(
+    api: MockCCHDO,
+    cruises: int,
+    profiles: int,
+    levels: int,
+    dtypes=("bottle", "ctd"),
+    cf_files: dict | None = None,
+) -> dict:
+    """Fill api with cruises that each have a CF file per dtype and nothing else
+
+    Pass the returned CF files back in to reseed without regenerating them.
+    """
+    if cf_files is None:
+        cf_files = {}
+    for cruise_id in range(1, cruises + 1):
+        expocode = f"MOCK{cruise_id:08d}"
+        api.add_cruise(
+            {
+                "id": cruise_id,
+                "expocode": expocode,
+                "files": [],
+                "geometry": {"track": {}},
+                "cf_robots": list(dtypes),
+            }
+        )
+        for dtype in dtypes:
+            key = (expocode, dtype)
+            if key not in cf_files:
+                cf_files[key] = synthetic_cf(expocode, dtype, profiles, levels)
+            api.add_file(
+                {
+                    "file_name": f"{expocode}_{dtype}.nc",
+                    "data_type": dtype,
+                    "data_format": "cf_netcdf",
+                    "file_type": "application/netcdf",
+                },
+                cf_files[key],
+                cruise_id=cruise_id,
+            )
+    return cf_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cruises", type=int, default=10)
+    parser.add_argument("--profiles", type=int, default=20)
+    parser.add_argument("--levels", type=int, default=36)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    args = parser.parse_args()
+
+    api = MockCCHDO(latency=args.latency)
+    seed(api, args.cruises, args.profiles, args.levels)
+    server = api.serve(port=args.port)
+    print(f"Serving a mock CCHDO on http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
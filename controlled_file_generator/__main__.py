@@ -7,59 +7,64 @@
 # ]
 # ///
 from collections import defaultdict
-from tempfile import NamedTemporaryFile
 import logging
 from functools import partial
-from base64 import b64encode
 from datetime import datetime, timezone
-from hashlib import sha256
 import argparse
-from operator import methodcaller
-import warnings
-import os
-from contextlib import contextmanager
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import get_context
+from pathlib import Path
 
-import xarray as xr
-from rich.logging import RichHandler
 from rich.console import Console
 
-import cchdo.hydro.accessors  # noqa
 from cchdo.auth.session import session as s
 
-ON_GHA = "GITHUB_RUN_ID" in os.environ
-
-if ON_GHA:
-    # closes the group started by the calling run line
-    # This group is for the uv installs
-    print("::endgroup::")
-
-
-@contextmanager
-def GHAGroup(group_name: str):
-    if ON_GHA:
-        print(f"::group::{group_name}")
-    yield
-    if ON_GHA:
-        print("::endgroup::")
-
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from robots_common import CCHDO_URL, metadata  # noqa: E402
+from robots_common.api import api_for  # noqa: E402
+from robots_common.catalogue import load_catalogue  # noqa: E402
+from robots_common.cf_cache import cf_cache  # noqa: E402
+from robots_common.conversion_cache import conversion_cache  # noqa: E402
+from robots_common.convert import (  # noqa: E402
+    TO_FTPYE,
+    Conversion,
+    convert_cf,
+    convert_dataset,
+    warm_up,
+)
+from robots_common.equivalence import equivalent  # noqa: E402
+from robots_common.gha import GHAGroup, buffered_group, close_install_group  # noqa: E402
+from robots_common.instrument import recorder, run_report  # noqa: E402
+from robots_common.isolate import (  # noqa: E402
+    SupervisedPool,
+    TaskKilled,
+    add_isolation_arguments,
+)
+from robots_common.journal import NO_JOURNAL, Journal  # noqa: E402
+from robots_common.logs import setup_logging  # noqa: E402
+from robots_common.schedule import (  # noqa: E402
+    Scheduler,
+    add_schedule_arguments,
+    cf_size,
+    newest_first,
+)
+from robots_common.shard import add_shard_arguments, describe, select_shard  # noqa: E402
+from robots_common.state import RunState  # noqa: E402
+from robots_common.spool import Output  # noqa: E402
+from robots_common.upload import JSON_HEADERS, JSONUpload  # noqa: E402
 
 logger = logging.getLogger(__name__)
 
+# set when anything went wrong, the run still continues with the other cruises
+dirty = False
+# expocodes of the cruises whose conversions were stopped, by reason
+conversion_errors = defaultdict(list)
+
 console = Console(color_system="256")
 
-FORMAT = "%(message)s"
-logging.basicConfig(
-    level="DEBUG",
-    format=FORMAT,
-    datefmt="[%X]",
-    handlers=[RichHandler(console=console)],
-)
+setup_logging(console, level="DEBUG")
 
-TO_FTPYE = {
-    "woce": "woce",
-    "exchange": "exchange",
-    "whp_netcdf": "coards",
-}
 TO_FTPYE_MIME = {
     "ctd": {
         "woce": "application/zip",
@@ -75,18 +80,18 @@ TO_FTPYE_MIME = {
 
 
 def make_cchdo_file_record(
-    data: bytes,
+    output: Output,
     fname,
     file_context,
     mime="text/plain",
     data_format="exchange",
     dtype="ctd",
 ):
+    """The file record for output, its body is added by JSONUpload when it is sent"""
     return {
         "file": {
             "type": mime,
             "name": fname,
-            "body": b64encode(data).decode("ascii"),
         },
         "container_contents": [],
         "data_container": "",
@@ -102,10 +107,10 @@ def make_cchdo_file_record(
                 "type": "Generated",
             }
         ],
-        "file_hash": sha256(data).hexdigest(),
+        "file_hash": output.file_hash,
         "file_name": fname,
         "file_path": "",
-        "file_size": len(data),
+        "file_size": output.size,
         "file_sources": [file_context["file_hash"]],
         "file_type": mime,
         "other_roles": [],
@@ -155,16 +160,8 @@ def gen_verified_patch(fname, cf_file, mime, data_format, dtype):
     ] # type: ignore
 
 
-def has_cf_file(cruise, files, dtype) -> bool:
-    for file in cruise["files"]:
-        if (fmeta := files.get(file)) is not None:
-            if (
-                fmeta["role"] == "dataset"
-                and fmeta["data_type"] == dtype
-                and fmeta["data_format"] == "cf_netcdf"
-            ):
-                return True
-    return False
+def has_cf_file(cruise, catalogue, dtype) -> bool:
+    return catalogue.cf_file(cruise, dtype) is not None
 
 
 def cf_robot_enabled(cruise, dtype="ctd"):
@@ -180,12 +177,13 @@ def is_cf_netcdf_dataset(file) -> bool:
     return is_cf and is_dataset
 
 
-def get_files_neededing_replacment(cruise, file_by_id, dtype):
+def get_files_neededing_replacment(cruise, catalogue, dtype, force=False):
+    """The cruise's CF file and its derived files needing replacement, or an error
+
+    With force the files already generated from the CF file are replaced too.
+    """
     logger.debug(f"Checking {cruise['expocode']}")
-    files = [file_by_id[id] for id in cruise["files"] if id in file_by_id]
-    dtype_files_in_dataset = list(
-        filter(lambda f: f["data_type"] == dtype and f["role"] == "dataset", files)
-    )
+    dtype_files_in_dataset = catalogue.find(cruise, "dataset", dtype)
     cf_files = list(
         filter(lambda f: f["data_format"] == "cf_netcdf", dtype_files_in_dataset)
     )
@@ -199,13 +197,13 @@ def get_files_neededing_replacment(cruise, file_by_id, dtype):
         return "Multiple CF Files"
 
     cf_file = cf_files[0]
-    cf_file_hash = cf_file["file_hash"]
+    from_cf = {file["id"] for file in catalogue.generated_from(cf_file["file_hash"])}
     files_need_replacing = dict()
     # preloads so things will be created
     for ftype in TO_FTPYE:
         files_need_replacing[ftype] = ftype
     for file in non_cf_files:
-        if cf_file_hash in file["file_sources"]:
+        if file["id"] in from_cf and not force:
             del files_need_replacing[file["data_format"]]
             continue
         if len(file["cruises"]) > 1:
@@ -219,94 +217,473 @@ def get_files_neededing_replacment(cruise, file_by_id, dtype):
     return (cf_file, files_need_replacing)
 
 
-def process_single_cruise(cruise, dtype, file_by_id, cf_file, files_need_replacing):
-    global dirty
-    file_url = f"https://cchdo.ucsd.edu{cf_file['file_path']}"
-    file_hashes = {file["file_hash"]: id for id, file in file_by_id.items()}
-
-    with NamedTemporaryFile() as tf:
-        logger.info(f"Loading {file_url}")
-        tf.write(s.get(file_url).content)
-        df = xr.load_dataset(tf.name, engine="netcdf4", decode_timedelta=False)
-
+def process_single_cruise(
+    cruise,
+    dtype,
+    catalogue,
+    cf_file,
+    files_need_replacing,
+    pool=None,
+    parallel_formats=False,
+    df=None,
+    journal=None,
+    state=None,
+) -> Future:
+    """Convert the files_need_replacing of one cruise and submit their upload
+
+    If a process pool is given the conversions run in it, otherwise in this process.
+    With parallel_formats each format is its own task in the pool so they run at the
+    same time, each worker opens the cached CF file itself. An already loaded
+    CF dataset can be passed as df to skip loading it again.
+
+    The uploads run on the API event loop so this returns once the conversions are
+    done, the returned future is False if anything went wrong. With a journal the
+    uploads are journaled first so a later run can finish them. Conversions are
+    taken from and added to the conversion cache. With state (a forced run) the
+    cruise is recorded as regenerated once its uploads are done.
+    """
+    ok = True
+    file_url = f"{CCHDO_URL}{cf_file['file_path']}"
+    cf_hash = cf_file["file_hash"]
+
+    conversions = {}
+    formats = []
+    for format in sorted(set(files_need_replacing.values())):
+        if (cached := conversion_cache.get(cf_hash, dtype, format)) is not None:
+            logger.info(f"Using the cached {format} conversion of {file_url}")
+            conversions[format] = Conversion(cached[0], output=cached[1])
+        else:
+            formats.append(format)
+
+    if len(formats) > 0:
+        logger.info(f"Converting {file_url} to {', '.join(formats)}")
+        converted, failed = convert(cf_file, formats, pool, parallel_formats, df)
+        for err in failed:
+            logger.error(f"Stopped converting {file_url}: {err}")
+        reasons = {
+            err.reason
+            if isinstance(err, TaskKilled)
+            else f"Conversion failed ({type(err).__name__})"
+            for err in failed
+        }
+        for reason in reasons:
+            conversion_errors[reason].append(cruise["expocode"])
+        for format, conversion in converted.items():
+            recorder.keep(conversion.stages)
+            if conversion.output is not None:
+                conversion_cache.put(
+                    cf_hash, dtype, format, conversion.fname, conversion.output
+                )
+        conversions.update(converted)
+
+    from_cf = {file["id"] for file in catalogue.generated_from(cf_hash)}
+    uploads = []
     for fid, format in files_need_replacing.items():
-        fname = df.cchdo.gen_fname(TO_FTPYE[format])
-        logger.info(f"Converting {file_url} to {format}: {fname}")
-        func = {
-            "woce": methodcaller("to_woce"),
-            "whp_netcdf": methodcaller("to_coards"),
-            "exchange": methodcaller("to_exchange"),
-        }[format]
-        try:
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                data: bytes = func(df.cchdo)
-        except Exception as err:
+        conversion = conversions[format]
+        fname = conversion.fname
+        if conversion.error is not None:
             logger.error(f"Crash on {format} conversion")
-            logger.error(err)
-            dirty = True
+            logger.error(conversion.error)
+            ok = False
             continue
+        logger.info(f"Converted {file_url} to {format}: {fname}")
         mime = TO_FTPYE_MIME[dtype][format]
         api_data = make_cchdo_file_record(
-            data, fname, cf_file, mime=mime, data_format=format, dtype=dtype
+            conversion.output, fname, cf_file, mime=mime, data_format=format, dtype=dtype
         )
-        if (existing_id := file_hashes.get(api_data["file_hash"])) is not None:
-            file_updated_patch = gen_verified_patch(fname, cf_file, mime=mime, data_format=format, dtype=dtype)
-            r = s.patch(
-                f"https://cchdo.ucsd.edu/api/v1/file/{existing_id}", json=file_updated_patch
-            )
-            logger.info(f"updated file source hash and metadata for existing file {fid}")
+        existing = catalogue.file_by_hash.get(api_data["file_hash"])
+        existing_id = None if existing is None else existing["id"]
+        if existing_id is None and same_as_replaced(fid, conversion.output, catalogue):
+            # it only needs the verified patch, there is nothing to replace it with
+            existing_id = fid
+        if existing_id in from_cf:
+            # e.g. forced, it already lists this CF file as its source
+            logger.info(f"Existing file {existing_id} is already made from this CF file")
             continue
+        uploads.append((fid, format, api_data, conversion.output, existing_id))
+
+    uploaded = {id(output) for *_, output, _ in uploads}
+    for conversion in conversions.values():
+        if conversion.output is not None and id(conversion.output) not in uploaded:
+            conversion.output.discard()
 
-        r = s.post("https://cchdo.ucsd.edu/api/v1/file", json=api_data)
+    cruise_journal = NO_JOURNAL
+    if journal is not None:
+        cruise_journal, uploads = journal_uploads(journal, cruise, cf_file, uploads, ok)
+
+    return api_for(s).submit(
+        upload_cruise(
+            cruise, dtype, catalogue, cf_file, uploads, ok, cruise_journal, state
+        )
+    )
+
+
+def try_process_single_cruise(expocode, **kwargs) -> Future | None:
+    """process_single_cruise, an error is logged and recorded instead of stopping the run"""
+    try:
+        return process_single_cruise(**kwargs)
+    except Exception as err:
+        logger.exception(f"Could not process {expocode}")
+        conversion_errors[f"Could not process cruise ({type(err).__name__})"].append(
+            expocode
+        )
+        return None
+
+
+def same_as_replaced(fid, output, catalogue) -> bool:
+    """True if the existing file fid only differs from output in volatile stamps"""
+    if not isinstance(fid, int):
+        return False
+    try:
+        same = equivalent(s, output, catalogue.file_by_id[fid])
+    except Exception as err:
+        logger.warning(f"Could not compare with the existing file {fid}: {err}")
+        return False
+    if same:
+        logger.info(f"Existing file {fid} only differs in volatile stamps, keeping it")
+    return same
+
+
+def convert(
+    cf_file, formats, pool=None, parallel_formats=False, df=None
+) -> tuple[dict[str, Conversion], list[Exception]]:
+    """Convert cf_file to formats, returns the conversions and the errors of failed tasks
+
+    The formats of a pool task that was killed or raised (e.g. could not open the
+    CF file) get a failed conversion, the other tasks' are kept.
+    """
+    if df is not None:
+        return convert_dataset(df, formats), []
+    # the cached file must outlive the conversions, other threads may be downloading
+    with cf_cache.pinned(cf_file["file_hash"]):
+        if pool is None:
+            return convert_cf(cf_cache.fetch(s, cf_file), formats), []
+
+        source = cf_cache.fetch_path(s, cf_file)
+        if parallel_formats:
+            tasks = [[format] for format in formats]
+        else:
+            tasks = [formats]
+        futures = [(task, pool.submit(convert_cf, source, task)) for task in tasks]
+        wait([future for _, future in futures])
+
+    conversions = {}
+    failed = []
+    for task, future in futures:
+        try:
+            conversions.update(future.result())
+        except Exception as err:
+            failed.append(err)
+            conversions.update(
+                {format: Conversion(cf_file["file_name"], error=str(err)) for format in task}
+            )
+    return conversions, failed
+
+
+def journal_uploads(journal, cruise, cf_file, uploads, converted):
+    """Journal the planned uploads of cruise, they then upload from the journal's copies
+
+    Uploads of a file that already exists only patch it, their output is not kept.
+    """
+    plan = {
+        "cruise_id": cruise["id"],
+        "cf_file": cf_file.as_dict(),
+        "converted": converted,
+        "uploads": [
+            {
+                "key": f"{format}:{fid}",
+                "fid": fid,
+                "format": format,
+                "record": api_data,
+                "existing_id": existing_id,
+            }
+            for fid, format, api_data, _, existing_id in uploads
+        ],
+    }
+    outputs = {
+        f"{format}:{fid}": output
+        for fid, format, _, output, existing_id in uploads
+        if existing_id is None
+    }
+    cruise_journal, stored = journal.begin(cruise["expocode"], plan, outputs)
+    for output in outputs.values():
+        output.discard()
+    return cruise_journal, [
+        (fid, format, api_data, stored.get(f"{format}:{fid}", output), existing_id)
+        for fid, format, api_data, output, existing_id in uploads
+    ]
+
+
+def resume_unfinished(journal, dtype, catalogue) -> int:
+    """Finish the journaled uploads an earlier run did not, returns how many cruises there were"""
+    unfinished = journal.unfinished()
+    for plan, cruise_journal, outputs in unfinished:
+        if (cruise := catalogue.cruise_by_id.get(plan["cruise_id"])) is None:
+            cruise_journal.abandon()
+            continue
+        logger.info(f"Resuming the unfinished uploads of {plan['expocode']}")
+        uploads = [
+            (u["fid"], u["format"], u["record"], outputs.get(u["key"]), u["existing_id"])
+            for u in plan["uploads"]
+        ]
+        api_for(s).submit(
+            upload_cruise(
+                cruise,
+                dtype,
+                catalogue,
+                plan["cf_file"],
+                uploads,
+                plan["converted"],
+                cruise_journal,
+            )
+        )
+    api_for(s).wait()
+    return len(unfinished)
+
+
+async def upload_file(
+    cruise,
+    dtype,
+    catalogue,
+    cf_file,
+    fid,
+    format,
+    api_data,
+    output,
+    existing_id,
+    journal=NO_JOURNAL,
+) -> bool:
+    """Create and attach one converted file then merge the file it replaces
+
+    Each request is a step in journal, steps it has as done are skipped.
+    """
+    api = api_for(s)
+    key = f"{format}:{fid}"
+    fname = api_data["file_name"]
+    mime = api_data["file_type"]
+    if existing_id is not None:
+
+        async def verify():
+            file_updated_patch = gen_verified_patch(fname, cf_file, mime=mime, data_format=format, dtype=dtype)
+            await api.patch(f"/api/v1/file/{existing_id}", json=file_updated_patch)
+            logger.info(f"updated file source hash and metadata for existing file {fid}")
+            return True
+
+        return await journal.step(f"{key}:verify", verify)
+
+    async def create():
+        if journal.replaying:
+            # an earlier run may have created it but died before journaling that
+            if (file := catalogue.file_by_hash.get(api_data["file_hash"])) is not None:
+                return str(file["id"])
+        with recorder.stage("upload", format=format) as stage:
+            r = await api.post(
+                "/api/v1/file",
+                data=JSONUpload(api_data, output.source, output.size),
+                headers=JSON_HEADERS,
+            )
+            stage["bytes"] = api_data["file_size"]
         if not r.ok:
-            dirty = True
             logger.critical("Error uploading file")
+            return None
+        return r.json()["message"].split("/")[-1]
 
-        new_id = r.json()["message"].split("/")[-1]
-        attach = s.post(
-            f"https://cchdo.ucsd.edu/api/v1/cruise/{cruise['id']}/files/{new_id}"
-        )
+    if (new_id := await journal.step(f"{key}:create", create)) is None:
+        return False
 
-        if not attach.ok:
-            dirty = True
+    async def attach():
+        r = await api.post(
+            f"/api/v1/cruise/{cruise['id']}/files/{new_id}", idempotent=True
+        )
+        if not r.ok:
             logger.critical("Error patching cruise")
+        return r.ok
 
-        if isinstance(fid, int):
+    if not await journal.step(f"{key}:attach", attach):
+        return False
+
+    if isinstance(fid, int):
+
+        async def merge():
             file_replaced_patch = gen_merge_patch()
-            logger.info(file_replaced_patch)
-            r = s.patch(
-                f"https://cchdo.ucsd.edu/api/v1/file/{fid}", json=file_replaced_patch
-            )
+            logger.debug("%s", file_replaced_patch)
+            r = await api.patch(f"/api/v1/file/{fid}", json=file_replaced_patch)
             if not r.ok:
-                dirty = True
                 logger.critical("Error patching the replaced file")
+            return r.ok
+
+        if not await journal.step(f"{key}:merge", merge):
+            return False
+    return True
+
+
+async def upload_cruise(
+    cruise,
+    dtype,
+    catalogue,
+    cf_file,
+    uploads,
+    ok=True,
+    journal=NO_JOURNAL,
+    state=None,
+) -> bool:
+    """Upload the converted files of a cruise one after the other
+
+    Returns False if anything went wrong. A failed replay of a journaled cruise is
+    abandoned, the cruise will be planned again. Only a forced run records the
+    cruise in state, otherwise the uploads change the cruise's files so the next
+    run plans it again and records it once it finds nothing to do.
+    """
+    global dirty
+    uploaded = True
+    try:
+        for fid, format, api_data, output, existing_id in uploads:
+            if not await upload_file(
+                cruise,
+                dtype,
+                catalogue,
+                cf_file,
+                fid,
+                format,
+                api_data,
+                output,
+                existing_id,
+                journal,
+            ):
+                uploaded = False
+    except Exception as err:
+        logger.critical(f"Error talking to the API for {cruise['expocode']}: {err}")
+        uploaded = False
+    finally:
+        for *_, output, _ in uploads:
+            if output is not None:
+                output.discard()
+
+    if uploaded:
+        journal.finish()
+    elif journal.replaying:
+        journal.abandon()
+
+    ok = ok and uploaded
+    if not ok and not journal.replaying:
+        dirty = True
+    if ok and state is not None:
+        state.record(forced(dtype), cruise["expocode"], cf_file)
+    return ok
+
+
+def conversion_pool(workers, task_timeout=None, task_max_rss=None):
+    """A pool of worker processes, supervised if there is a task limit"""
+    if task_timeout is not None or task_max_rss is not None:
+        return SupervisedPool(workers, task_timeout, task_max_rss, warm_up)
+    return ProcessPoolExecutor(workers, mp_context=get_context("spawn"))
 
 
-def cruise_add_from_cf(dtype):
+def report_conversion_errors():
     global dirty
-    logger.info(f"Checking and converting files for data type: {dtype}")
-    with GHAGroup("Load cruise and file metadata"):
-        logger.info("Loading Cruise and File information")
-        cruises = s.get("https://cchdo.ucsd.edu/api/v1/cruise/all").json()
-        files = s.get("https://cchdo.ucsd.edu/api/v1/file/all").json()
+    for err, expocodes in conversion_errors.items():
+        dirty = True
+        logger.error(f"Found {len(expocodes)} cruises with error {err}")
+        logger.error("%s", expocodes)
 
-    cruises_controlled = list(filter(partial(cf_robot_enabled, dtype=dtype), cruises))
-    logger.info(f"Found {len(cruises_controlled)} controlled cruises")
 
-    file_by_id = {file["id"]: file for file in files}
-    cruise_by_expocode = {cruise["expocode"]: cruise for cruise in cruises_controlled}
+def process_cruises_concurrently(
+    cruises,
+    workers,
+    parallel_formats=False,
+    scheduler=None,
+    task_timeout=None,
+    task_max_rss=None,
+):
+    """Run process_single_cruise for many cruises at once
+
+    Downloads happen on a pool of threads while the conversions run in a pool
+    of worker processes. There are twice as many threads as processes so the
+    next cruises are being downloaded while the processes are busy converting,
+    the thread count (and scheduler's memory budget) also bounds how many
+    cruises are converting at a time. With a task limit the processes are
+    supervised, see robots_common.isolate.
+    """
+    scheduler = scheduler or Scheduler()
+
+    def run(expocode, kwargs):
+        with scheduler.run(expocode, cf_size(kwargs["cf_file"])) as slot:
+            if not slot:
+                return
+            with buffered_group(f"Processing cruise {expocode}", "cruise", expocode):
+                slot.until(
+                    try_process_single_cruise(
+                        expocode, **kwargs, pool=pool, parallel_formats=parallel_formats
+                    )
+                )
+
+    with (
+        conversion_pool(workers, task_timeout, task_max_rss) as pool,
+        ThreadPoolExecutor(2 * workers) as threads,
+    ):
+        futures = [
+            threads.submit(run, expocode, kwargs) for expocode, kwargs in cruises
+        ]
+        for future in futures:
+            future.result()
+
+
+def forced(dtype) -> str:
+    """The run state task of forced runs for dtype"""
+    return f"{dtype}-forced"
+
+
+def plan_derived(dtype, catalogue, state, journal=None, force=False):
+    """The (expocode, process_single_cruise kwargs) of cruises needing work for dtype
+
+    Cruises last found up to date with the same CF file, dtype dataset files and
+    cchdo.hydro version are skipped unless state is in full mode. With force
+    every derived file is regenerated instead, skipping the cruises an earlier
+    forced run already did with the same CF file and cchdo.hydro version so a
+    run cut short by its time budget carries on where it stopped.
+    """
+    global dirty
+    cruises_controlled = list(
+        filter(partial(cf_robot_enabled, dtype=dtype), catalogue.cruises)
+    )
+    logger.info(f"Found {len(cruises_controlled)} controlled cruises")
 
-    ffunc = partial(has_cf_file, files=file_by_id, dtype=dtype)
+    ffunc = partial(has_cf_file, catalogue=catalogue, dtype=dtype)
 
     cruises_with_cf = list(filter(ffunc, cruises_controlled))
 
+    if force:
+        cruises_changed = [
+            cruise
+            for cruise in cruises_with_cf
+            if not state.unchanged(
+                forced(dtype), cruise["expocode"], catalogue.cf_file(cruise, dtype)
+            )
+        ]
+        logger.info(
+            f"Skipping {len(cruises_with_cf) - len(cruises_changed)} cruises already regenerated"
+        )
+    else:
+        cruises_changed = [
+            cruise
+            for cruise in cruises_with_cf
+            if not state.unchanged(
+                dtype,
+                cruise["expocode"],
+                catalogue.cf_file(cruise, dtype),
+                catalogue.find(cruise, "dataset", dtype),
+            )
+        ]
+        logger.info(
+            f"Skipping {len(cruises_with_cf) - len(cruises_changed)} cruises unchanged since the last run"
+        )
+
     with GHAGroup("Find cruises that need work"):
         cruise_files_need_replacing = {
             cruise["expocode"]: get_files_neededing_replacment(
-                cruise, file_by_id=file_by_id, dtype=dtype
+                cruise, catalogue=catalogue, dtype=dtype, force=force
             )
-            for cruise in cruises_with_cf
+            for cruise in cruises_changed
         }
 
     cruises_with_work = {}
@@ -317,37 +694,169 @@ def cruise_add_from_cf(dtype):
             cf_file, files_need_replacing = result
             if len(files_need_replacing) == 0:
                 cruises_nothing_to_do.append(expocode)
+                cruise = catalogue.cruise_by_expocode[expocode]
+                state.record(
+                    dtype, expocode, cf_file, catalogue.find(cruise, "dataset", dtype)
+                )
                 continue
             cruises_with_work[expocode] = result
         else:
             cruises_errors[result].append(expocode)
     with GHAGroup(f"Up to date cruises ({len(cruises_nothing_to_do)})"):
         logger.info(f"Found {len(cruises_nothing_to_do)} cruises that are up to date")
-        logger.info(cruises_nothing_to_do)
+        logger.debug("%s", cruises_nothing_to_do)
     for err, expocodes in cruises_errors.items():
         dirty = True
         logger.error(f"Found {len(expocodes)} cruises with error {err}")
-        logger.error(expocodes)
+        logger.error("%s", expocodes)
 
+    cruise_work = []
     for expocode, result in cruises_with_work.items():
-        cruise = cruise_by_expocode[expocode]
         cf_file, files_need_replacing = result
-        with GHAGroup(f"Processing cruise {expocode}"):
-            process_single_cruise(
-                cruise,
-                dtype=dtype,
-                file_by_id=file_by_id,
-                cf_file=cf_file,
-                files_need_replacing=files_need_replacing,
-            )
+        kwargs = dict(
+            cruise=catalogue.cruise_by_expocode[expocode],
+            dtype=dtype,
+            catalogue=catalogue,
+            cf_file=cf_file,
+            files_need_replacing=files_need_replacing,
+            journal=journal,
+            state=state if force else None,
+        )
+        cruise_work.append((expocode, kwargs))
+
+    return cruise_work
+
+
+def cruise_add_from_cf(
+    dtype,
+    workers=1,
+    parallel_formats=False,
+    full=False,
+    shard=None,
+    shard_by="expocode",
+    time_budget=None,
+    memory_budget=None,
+    task_timeout=None,
+    task_max_rss=None,
+    force=False,
+) -> list[str]:
+    """Convert and upload the derived files of dtype, returns the deferred expocodes"""
+    logger.info(f"Checking and converting files for data type: {dtype}")
+    scheduler = Scheduler(time_budget, memory_budget)
+    isolated = task_timeout is not None or task_max_rss is not None
+    conversion_errors.clear()
+    state = RunState(full=full)
+    journal = Journal(dtype, shard=shard)
+    if len(journal.unfinished()) > 0:
+        # the changes the earlier run did make have to be seen
+        metadata.invalidate()
+        with GHAGroup("Resume unfinished cruises"):
+            resume_unfinished(journal, dtype, load_catalogue(s))
+            metadata.invalidate()
+
+    with GHAGroup("Load cruise and file metadata"):
+        logger.info("Loading Cruise and File information")
+        catalogue = load_catalogue(s)
+
+    cruise_work = plan_derived(dtype, catalogue, state, journal, force)
+    if shard is not None:
+        cruise_work = select_shard(
+            cruise_work,
+            shard,
+            expocode=lambda w: w[0],
+            size=lambda w: w[1]["cf_file"].get("file_size") or 0,
+            by=shard_by,
+        )
+        logger.info(f"{len(cruise_work)} cruises are in {describe(shard)}")
+    cruise_work = newest_first(cruise_work, lambda w: w[1]["cf_file"])
+
+    if workers > 1 and len(cruise_work) > 1:
+        process_cruises_concurrently(
+            cruise_work,
+            workers,
+            parallel_formats,
+            scheduler,
+            task_timeout,
+            task_max_rss,
+        )
+    elif (parallel_formats or isolated) and len(cruise_work) > 0:
+        pool_size = len(TO_FTPYE) if parallel_formats else 1
+        with conversion_pool(pool_size, task_timeout, task_max_rss) as pool:
+            for expocode, kwargs in cruise_work:
+                with scheduler.run(expocode, cf_size(kwargs["cf_file"])) as slot:
+                    if not slot:
+                        continue
+                    with GHAGroup(f"Processing cruise {expocode}", "cruise", expocode):
+                        slot.until(
+                            try_process_single_cruise(
+                                expocode,
+                                **kwargs,
+                                pool=pool,
+                                parallel_formats=parallel_formats,
+                            )
+                        )
+    else:
+        for expocode, kwargs in cruise_work:
+            with scheduler.run(expocode, cf_size(kwargs["cf_file"])) as slot:
+                if not slot:
+                    continue
+                with GHAGroup(f"Processing cruise {expocode}", "cruise", expocode):
+                    slot.until(try_process_single_cruise(expocode, **kwargs))
+
+    api_for(s).wait()
+    report_conversion_errors()
+    journal.compact()
+    if len(cruise_work) > 0:
+        metadata.invalidate()
+    state.save()
+    scheduler.report()
+    return scheduler.deferred
 
 
 if __name__ == "__main__":
-    global dirty
-    dirty = False
+    close_install_group()
     parser = argparse.ArgumentParser()
     parser.add_argument("dtype", choices=["bottle", "ctd", "summary"])
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of cruises to process at once, conversions run in this many processes",
+    )
+    parser.add_argument(
+        "--parallel-formats",
+        action="store_true",
+        help="run the conversions to each format of a cruise in separate processes",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="check every controlled cruise, not only those changed since the last run",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="regenerate every derived file, even those already made from the current CF file, "
+        "skipping cruises an earlier forced run already did with this cchdo.hydro version",
+    )
+    add_shard_arguments(parser)
+    add_schedule_arguments(parser)
+    add_isolation_arguments(parser)
     args = parser.parse_args()
-    cruise_add_from_cf(dtype=args.dtype)
+    with run_report(args.dtype, shard=args.shard) as outcome:
+        outcome["deferred"] = cruise_add_from_cf(
+            dtype=args.dtype,
+            workers=args.workers,
+            parallel_formats=args.parallel_formats,
+            full=args.full,
+            shard=args.shard,
+            shard_by=args.shard_by,
+            time_budget=args.time_budget,
+            memory_budget=args.memory_budget,
+            task_timeout=args.task_timeout,
+            task_max_rss=args.task_max_rss,
+            force=args.force,
+        )
+        outcome["failed"] = dirty
     if dirty:
         exit(1)
@@ -0,0 +1,74 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = []
+# ///
+"""Combine the run reports of the shards of a run.
+
+Writes one report and step summary for the whole run and exits non zero if
+any shard failed or did not leave a report.
+"""
+import argparse
+import json
+import logging
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from robots_common.instrument import merge_reports, write_step_summary  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(level="INFO", format="%(message)s")
+
+
+def load_reports(paths: list[Path]) -> list[dict]:
+    files = []
+    for path in paths:
+        files.extend(sorted(path.rglob("*.json")) if path.is_dir() else [path])
+    return [json.loads(file.read_text()) for file in files]
+
+
+def missing_shards(reports: list[dict]) -> list[str]:
+    present = defaultdict(set)
+    for report in reports:
+        if (shard := report.get("shard")) is not None:
+            index, count = shard
+            present[report["robot"], count].add(index)
+    return [
+        f"{robot} {index}/{count}"
+        for (robot, count), indices in present.items()
+        for index in range(1, count + 1)
+        if index not in indices
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "reports", nargs="+", type=Path, help="report files or directories of them"
+    )
+    parser.add_argument("--output", type=Path, help="write the merged report here")
+    args = parser.parse_args()
+
+    reports = load_reports(args.reports)
+    if len(reports) == 0:
+        logger.error("No reports found")
+        exit(1)
+
+    merged = merge_reports(reports)
+    if len(missing := missing_shards(reports)) > 0:
+        logger.error(f"No report from {', '.join(missing)}")
+        merged["failed"] = True
+    if args.output is not None:
+        args.output.write_text(json.dumps(merged, indent=2))
+    write_step_summary(merged)
+
+    for report in reports:
+        shard = report.get("shard")
+        name = report["robot"]
+        if shard is not None:
+            name = f"{name} {shard[0]}/{shard[1]}"
+        logger.info(f"{name}: {'errors' if report.get('failed') else 'ok'}")
+    if merged["failed"]:
+        exit(1)
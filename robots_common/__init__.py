@@ -0,0 +1,10 @@
+import os
+from pathlib import Path
+
+# can be pointed at a local stand in, e.g. bench/mock_server.py
+CCHDO_URL = os.environ.get("CCHDO_URL", "https://cchdo.ucsd.edu")
+
+# Shared between the robots so back to back runs (e.g. bottle then ctd) can reuse work
+CACHE_DIR = Path(
+    os.environ.get("CCHDO_ROBOTS_CACHE", Path.home() / ".cache" / "cchdo-robots")
+)
@@ -0,0 +1,135 @@
+"""Asyncio client for the CCHDO API calls the robots make.
+
+Requests go through the cchdo.auth session (so the API key handling stays in
+one place) on a small pool of threads, the session keeps the same number of
+keep-alive connections open. An event loop on its own thread runs one
+coroutine per cruise: the steps of a cruise (create, attach, merge patch)
+are awaited in order while independent cruises overlap.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import cache
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+from . import CCHDO_URL
+
+logger = logging.getLogger(__name__)
+
+MAX_IN_FLIGHT = int(os.environ.get("CCHDO_API_CONCURRENCY", 8))
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_STATUS = {429, 502, 503, 504}
+
+
+class AsyncAPI:
+    """At most max_in_flight requests at a time, submit blocks while max_pending cruises are unfinished"""
+
+    def __init__(
+        self,
+        session,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        max_pending: int | None = None,
+        retries: int = 3,
+        backoff: float = 0.5,
+    ):
+        self.session = session
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        session.mount(
+            CCHDO_URL, HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        )
+        # each pending cruise holds on to its converted files
+        self._pending = threading.BoundedSemaphore(max_pending or 4 * max_in_flight)
+        self._futures: set[Future] = set()
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(
+                    ThreadPoolExecutor(self.max_in_flight, thread_name_prefix="api")
+                )
+                self._limit = asyncio.Semaphore(self.max_in_flight)
+                threading.Thread(target=loop.run_forever, daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    async def request(self, method: str, path: str, idempotent=None, **kwargs):
+        """Make a request to path on CCHDO_URL
+
+        Idempotent requests (by method unless given) are retried with backoff
+        on connection errors and on 429 and 50x gateway responses.
+        """
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        url = f"{CCHDO_URL}{path}"
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries or not idempotent
+            try:
+                async with self._limit:
+                    r = await asyncio.to_thread(
+                        self.session.request, method, url, **kwargs
+                    )
+            except (ConnectionError, Timeout) as err:
+                if last:
+                    raise
+                logger.warning(f"{method} {path} failed ({err}), retrying")
+            else:
+                if last or r.status_code not in RETRY_STATUS:
+                    return r
+                logger.warning(f"{method} {path} returned {r.status_code}, retrying")
+            await asyncio.sleep(self.backoff * 2**attempt * random.uniform(0.5, 1.5))
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    async def patch(self, path, **kwargs):
+        return await self.request("PATCH", path, **kwargs)
+
+    def submit(self, coro) -> Future:
+        """Run coro on the event loop, the returned future has its result"""
+        loop = self._start()
+        self._pending.acquire()
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future):
+        with self._lock:
+            self._futures.discard(future)
+        self._pending.release()
+
+    def wait(self):
+        """Block until everything submitted so far has finished"""
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+
+
+def succeeded(future: Future) -> bool:
+    """The result of a finished future of submit, False if it raised"""
+    if (err := future.exception()) is not None:
+        logger.critical(f"Error talking to the API: {err}")
+        return False
+    return future.result()
+
+
+@cache
+def api_for(session) -> AsyncAPI:
+    """The AsyncAPI of session, shared by every robot running in this process"""
+    return AsyncAPI(session)
@@ -0,0 +1,57 @@
+"""Index of the cruise and file catalogue, built once per run.
+
+The robots look files up by id, by hash, by what cruise they are attached to
+(and their role, data type and format) and by which files they were generated
+from. Building these up front keeps each lookup O(1) so planning scales with
+the size of the archive rather than cruises times files.
+"""
+
+from collections import defaultdict
+
+from . import metadata
+
+
+class Catalogue:
+    def __init__(self, cruises, files):
+        self.cruises = cruises
+        self.files = files
+
+        self.cruise_by_id = {cruise["id"]: cruise for cruise in cruises}
+        self.cruise_by_expocode = {cruise["expocode"]: cruise for cruise in cruises}
+        self.file_by_id = {file["id"]: file for file in files}
+        self.file_by_hash = {file["file_hash"]: file for file in files}
+
+        self.files_by_source = defaultdict(list)
+        for file in files:
+            for source in file["file_sources"]:
+                self.files_by_source[source].append(file)
+
+        # keyed by (cruise id, role, data_type, data_format), None matches anything
+        # for data_type and data_format, files are kept in the cruise's order
+        self._attached = defaultdict(list)
+        for cruise in cruises:
+            for file_id in cruise["files"]:
+                if (file := self.file_by_id.get(file_id)) is None:
+                    continue
+                for data_type in (file["data_type"], None):
+                    for data_format in (file["data_format"], None):
+                        key = (cruise["id"], file["role"], data_type, data_format)
+                        self._attached[key].append(file)
+
+    def find(self, cruise, role, data_type=None, data_format=None) -> list[dict]:
+        """Files attached to cruise with the given role, data_type and data_format"""
+        return self._attached.get((cruise["id"], role, data_type, data_format), [])
+
+    def generated_from(self, file_hash) -> list[dict]:
+        """Files listing file_hash in their file_sources"""
+        return self.files_by_source.get(file_hash, [])
+
+    def cf_file(self, cruise, data_type=None):
+        """The first CF netCDF dataset file of cruise, or None"""
+        if cf_files := self.find(cruise, "dataset", data_type, "cf_netcdf"):
+            return cf_files[0]
+        return None
+
+
+def load_catalogue(session, **kwargs) -> Catalogue:
+    return Catalogue(*metadata.load_cruises_and_files(session, **kwargs))
@@ -0,0 +1,157 @@
+"""Content addressed cache of CF netCDF files keyed by their catalogue file_hash.
+
+The file_hash the API reports is the sha256 of the file contents, so a
+cached entry never goes stale, when a CF file changes it gets a new hash.
+Entries are evicted least recently used first once the cache grows past
+``max_bytes``, use is tracked with the file mtime.
+
+Downloads are streamed in chunks and hashed as they arrive, so memory use is
+bounded by the chunk size rather than the file size. Files no larger than
+``memory_max`` are instead collected in memory and handed back as bytes,
+they are still written to the cache but do not need to be read back.
+
+Entries being read, e.g. a path waiting for a worker process to open it, are
+pinned so another thread's download does not evict them.
+"""
+
+import logging
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from hashlib import sha256
+from pathlib import Path
+
+from . import CACHE_DIR, CCHDO_URL, lru
+from .instrument import recorder
+
+logger = logging.getLogger(__name__)
+
+CF_CACHE_DIR = CACHE_DIR / "cf"
+DEFAULT_MAX_BYTES = int(os.environ.get("CCHDO_CF_CACHE_SIZE", 5 * 1024**3))
+DEFAULT_MEMORY_MAX = int(os.environ.get("CCHDO_CF_MEMORY_MAX", 32 * 1024**2))
+CHUNK_SIZE = 1024**2
+
+
+class CFCache:
+    def __init__(
+        self,
+        root: Path = CF_CACHE_DIR,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        memory_max: int = DEFAULT_MEMORY_MAX,
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.memory_max = memory_max
+        self._lock = threading.Lock()
+        self._pins = Counter()
+
+    def path_for(self, file_hash: str) -> Path:
+        return self.root / file_hash[:2] / f"{file_hash}.nc"
+
+    def get(self, file_hash: str) -> Path | None:
+        path = self.path_for(file_hash)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, file_hash: str, data: bytes) -> Path:
+        if (actual := sha256(data).hexdigest()) != file_hash:
+            raise ValueError(f"Hash mismatch, expected {file_hash} got {actual}")
+
+        path = self.path_for(file_hash)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self._tmp_path(path)
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        self.evict()
+        return path
+
+    @staticmethod
+    def _tmp_path(path: Path) -> Path:
+        return path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+
+    def _stream_to_disk(self, file_hash: str, chunks) -> Path:
+        path = self.path_for(file_hash)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self._tmp_path(path)
+        hasher = sha256()
+        try:
+            with tmp.open("wb") as f:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    f.write(chunk)
+            if (actual := hasher.hexdigest()) != file_hash:
+                raise ValueError(f"Hash mismatch, expected {file_hash} got {actual}")
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        self.evict()
+        return path
+
+    @contextmanager
+    def pinned(self, file_hash: str):
+        """Keep the entry for file_hash from being evicted in this block"""
+        with self._lock:
+            self._pins[file_hash] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins[file_hash] -= 1
+                if self._pins[file_hash] == 0:
+                    del self._pins[file_hash]
+
+    def _pinned(self, path: Path) -> bool:
+        with self._lock:
+            return path.stem in self._pins
+
+    def evict(self):
+        lru.evict(
+            self.root,
+            "*/*.nc",
+            self.max_bytes,
+            remove=lambda path: path.unlink(missing_ok=True),
+            keep=self._pinned,
+        )
+
+    def fetch(self, session, cf_file) -> Path | bytes:
+        """A local copy of cf_file, downloading it only on a cache miss
+
+        This is the cached path, or the contents if the file was small enough
+        to be downloaded into memory.
+        """
+        file_hash = cf_file["file_hash"]
+        if (path := self.get(file_hash)) is not None:
+            logger.info(f"Using cached {cf_file['file_path']}")
+            return path
+
+        file_url = f"{CCHDO_URL}{cf_file['file_path']}"
+        logger.info(f"Loading {file_url}")
+        with (
+            recorder.stage("download") as stage,
+            session.get(file_url, stream=True) as r,
+        ):
+            r.raise_for_status()
+            chunks = r.iter_content(chunk_size=CHUNK_SIZE)
+            if (cf_file.get("file_size") or self.memory_max + 1) <= self.memory_max:
+                data = b"".join(chunks)
+                stage["bytes"] = len(data)
+                self.put(file_hash, data)
+                return data
+            path = self._stream_to_disk(file_hash, chunks)
+            stage["bytes"] = path.stat().st_size
+            return path
+
+    def fetch_path(self, session, cf_file) -> Path:
+        """Like fetch but always a path, for handing the file to another process
+
+        Call it inside ``pinned`` until the other process has opened the file.
+        """
+        self.fetch(session, cf_file)
+        return self.path_for(cf_file["file_hash"])
+
+
+cf_cache = CFCache()
@@ -0,0 +1,82 @@
+"""Cache of conversion outputs keyed by CF file, format, data type and cchdo.hydro version.
+
+Re-running a cruise whose CF file has not changed, e.g. after a failed upload
+or a manual dispatch, then goes straight to the upload without converting
+again. Like the CF cache, entries are evicted least recently used first once
+the cache grows past ``max_bytes`` and use is tracked with the file mtime.
+
+Hits are copied out of the cache (or read into memory if small) so an entry
+can be evicted while its output is still waiting to be uploaded.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+from . import CACHE_DIR, lru
+from .spool import SPOOL_DIR, SPOOL_THRESHOLD, Output
+from .state import HYDRO_VERSION
+
+logger = logging.getLogger(__name__)
+
+CONVERSION_CACHE_DIR = CACHE_DIR / "conversions"
+DEFAULT_MAX_BYTES = int(os.environ.get("CCHDO_CONVERSION_CACHE_SIZE", 1024**3))
+
+
+class ConversionCache:
+    def __init__(self, root: Path = CONVERSION_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def path_for(self, cf_hash: str, dtype: str, format: str) -> Path:
+        name = f"{cf_hash}_{dtype}_{format}_{HYDRO_VERSION}.out"
+        return self.root / cf_hash[:2] / name
+
+    def get(self, cf_hash: str, dtype: str, format: str) -> tuple[str, Output] | None:
+        """The file name and output of an earlier conversion, or None"""
+        path = self.path_for(cf_hash, dtype, format)
+        try:
+            os.utime(path)
+            meta = json.loads(path.with_suffix(".json").read_text())
+            if meta["size"] <= SPOOL_THRESHOLD:
+                output = Output(meta["file_hash"], meta["size"], data=path.read_bytes())
+            else:
+                SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+                fd, spooled = tempfile.mkstemp(suffix=f"_{meta['fname']}", dir=SPOOL_DIR)
+                os.close(fd)
+                shutil.copyfile(path, spooled)
+                output = Output(meta["file_hash"], meta["size"], path=Path(spooled))
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+        return meta["fname"], output
+
+    def put(self, cf_hash: str, dtype: str, format: str, fname: str, output: Output):
+        path = self.path_for(cf_hash, dtype, format)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            if output.path is not None:
+                shutil.copyfile(output.path, tmp)
+            else:
+                tmp.write_bytes(output.data)
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        meta = {"fname": fname, "file_hash": output.file_hash, "size": output.size}
+        path.with_suffix(".json").write_text(json.dumps(meta))
+        self.evict()
+
+    @staticmethod
+    def _remove(path: Path):
+        path.unlink(missing_ok=True)
+        path.with_suffix(".json").unlink(missing_ok=True)
+
+    def evict(self):
+        lru.evict(self.root, "*/*.out", self.max_bytes, remove=self._remove)
+
+
+conversion_cache = ConversionCache()
@@ -0,0 +1,79 @@
+"""CF to legacy format conversions, runnable in a worker process.
+
+Workers are given the path of the cached CF file rather than a loaded
+dataset and large outputs come back spooled to disk so nothing large needs to
+be pickled. The stages timed doing the
+conversion come back with it, the caller keeps them in its run report.
+
+The datasets converted come from ``load_cf``, which imports cchdo.hydro, so
+importing this module for ``TO_FTPYE`` does not.
+"""
+
+import warnings
+from dataclasses import dataclass, field
+from operator import methodcaller
+from pathlib import Path
+
+from .datasets import load_cf
+from .instrument import recorder
+from .spool import Output
+
+TO_FTPYE = {
+    "woce": "woce",
+    "exchange": "exchange",
+    "whp_netcdf": "coards",
+}
+
+CONVERTERS = {
+    "woce": methodcaller("to_woce"),
+    "whp_netcdf": methodcaller("to_coards"),
+    "exchange": methodcaller("to_exchange"),
+}
+
+
+def warm_up():
+    """Import cchdo.hydro ahead of the first conversion in a worker process"""
+    import cchdo.hydro.accessors  # noqa: F401
+
+
+@dataclass
+class Conversion:
+    fname: str
+    output: Output | None = None
+    error: str | None = None
+    stages: list[dict] = field(default_factory=list)
+
+
+def convert_cf(source: Path | bytes, formats) -> dict[str, Conversion]:
+    """Convert the CF file at source to each of formats
+
+    A failing format does not stop the others, its error is recorded instead.
+    """
+    with recorder.collect() as stages:
+        df = load_cf(source, tasks=formats)
+    results = convert_dataset(df, formats)
+    # the load was shared by all the formats, report it once
+    results[formats[0]].stages[:0] = stages
+    return results
+
+
+def convert_dataset(df, formats) -> dict[str, Conversion]:
+    results = {}
+    for format in formats:
+        fname = df.cchdo.gen_fname(TO_FTPYE[format])
+        with recorder.collect() as stages:
+            try:
+                with (
+                    recorder.stage("convert", format=format) as stage,
+                    warnings.catch_warnings(),
+                ):
+                    warnings.simplefilter("ignore")
+                    data: bytes = CONVERTERS[format](df.cchdo)
+                    output = Output.spool(data, fname)
+                    del data
+                    stage["bytes"] = output.size
+            except Exception as err:
+                results[format] = Conversion(fname, error=str(err), stages=stages)
+                continue
+        results[format] = Conversion(fname, output=output, stages=stages)
+    return results
@@ -0,0 +1,81 @@
+"""Opening CF netCDF files from the cache, either from disk or from memory.
+
+Datasets are opened lazily and only the variables a task needs are read:
+the trackline only needs positions and the sumfile only needs station level
+metadata plus the pressure and sample columns. The format conversions write
+out every parameter so they still read the whole file.
+
+xarray, netCDF4 and cchdo.hydro are only imported once a file is opened, so
+a run that finds nothing to do never loads them.
+"""
+
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from .instrument import recorder
+
+if TYPE_CHECKING:
+    import xarray as xr
+
+PROFILE_DIM = "N_PROF"
+LEVELS_DIM = "N_LEVELS"
+
+
+def _track_variables(ds: "xr.Dataset") -> set[str]:
+    return {"longitude", "latitude"}
+
+
+def _summary_variables(ds: "xr.Dataset") -> set[str]:
+    # to_sum uses the max pressure and counts samples per profile
+    station_level = {
+        name for name, var in ds.variables.items() if LEVELS_DIM not in var.dims
+    }
+    return station_level | {"pressure", "sample"}
+
+
+TASK_VARIABLES = {
+    "track": _track_variables,
+    "summary": _summary_variables,
+    # the TO_FTPYE formats include every parameter
+    "woce": None,
+    "exchange": None,
+    "whp_netcdf": None,
+}
+
+
+def open_cf(source: Path | bytes) -> "xr.Dataset":
+    import netCDF4
+    import xarray as xr
+
+    if isinstance(source, bytes):
+        nc = netCDF4.Dataset("inmemory.nc", memory=source)
+        return xr.open_dataset(
+            xr.backends.NetCDF4DataStore(nc), decode_timedelta=False
+        )
+    return xr.open_dataset(source, engine="netcdf4", decode_timedelta=False)
+
+
+def task_variables(ds: "xr.Dataset", tasks) -> set[str] | None:
+    """The variables of ds needed by all of tasks, None meaning all of them"""
+    names = set()
+    for task in tasks:
+        if (select := TASK_VARIABLES[task]) is None:
+            return None
+        names |= select(ds)
+    return names
+
+
+def load_cf(source: Path | bytes, tasks=("exchange",)) -> "xr.Dataset":
+    """Read the variables needed for tasks from source into memory
+
+    This also registers the ``cchdo`` accessor the robots use on the dataset.
+    """
+    import cchdo.hydro.accessors  # noqa: F401
+
+    with recorder.stage("load") as stage, open_cf(source) as ds:
+        if (names := task_variables(ds, tasks)) is not None:
+            names |= set(ds.dims)
+            ds = ds.drop_vars([name for name in ds.variables if name not in names])
+        ds = ds.load()
+        stage["bytes"] = ds.nbytes
+        return ds
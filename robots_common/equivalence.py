@@ -0,0 +1,73 @@
+"""Comparing converted files while ignoring the parts that change every run.
+
+A conversion of unchanged data still gets a new hash: exchange files start
+with a stamp of the day they were written, the netCDF files have a
+Creation_Time attribute and zip archives store the time each member was
+written. ``content_digest`` hashes a file with those normalized away, so a
+regenerated file can be matched to the existing file it would replace and
+that file kept instead.
+"""
+
+import logging
+import re
+import tempfile
+import zipfile
+from hashlib import sha256
+from typing import BinaryIO
+
+from . import CCHDO_URL
+from .instrument import recorder
+from .spool import SPOOL_DIR, SPOOL_THRESHOLD, Output
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024**2
+
+# (pattern, replacement) applied to the start of every file and zip member
+VOLATILE = [
+    # BOTTLE,20240131CCHHYDRO
+    (re.compile(rb"\A(BOTTLE|CTD),\d{8}"), rb"\1,"),
+    (
+        re.compile(
+            rb"(Creation_Time.{0,32}?)\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?Z", re.S
+        ),
+        rb"\1",
+    ),
+]
+
+
+def _normalized(data: bytes) -> bytes:
+    for pattern, replacement in VOLATILE:
+        data = pattern.sub(replacement, data, count=1)
+    return data
+
+
+def content_digest(f: BinaryIO) -> str:
+    """sha256 of the file f with the volatile stamps and zip member dates left out"""
+    if zipfile.is_zipfile(f):
+        digest = sha256(b"zip")
+        with zipfile.ZipFile(f) as archive:
+            for name in sorted(archive.namelist()):
+                member = sha256(_normalized(archive.read(name))).hexdigest()
+                digest.update(f"{name}\0{member}\0".encode("utf8"))
+        return digest.hexdigest()
+    f.seek(0)
+    return sha256(_normalized(f.read())).hexdigest()
+
+
+def equivalent(session, output: Output, file) -> bool:
+    """True if output only differs from the catalogue file in volatile stamps"""
+    with output.open() as f:
+        new = content_digest(f)
+
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    with (
+        recorder.stage("compare") as stage,
+        session.get(f"{CCHDO_URL}{file['file_path']}", stream=True) as r,
+        tempfile.SpooledTemporaryFile(SPOOL_THRESHOLD, dir=SPOOL_DIR) as f,
+    ):
+        r.raise_for_status()
+        for chunk in r.iter_content(CHUNK_SIZE):
+            f.write(chunk)
+        stage["bytes"] = f.tell()
+        return content_digest(f) == new
@@ -0,0 +1,81 @@
+"""Github Actions log grouping shared by the robots."""
+
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from .instrument import labelled, recorder
+from .logs import print_line
+
+ON_GHA = "GITHUB_RUN_ID" in os.environ
+
+
+def close_install_group():
+    # closes the group started by the calling run line
+    # This group is for the uv installs
+    if ON_GHA:
+        print_line("::endgroup::")
+
+
+@contextmanager
+def _log_group(group_name: str):
+    if ON_GHA:
+        print_line(f"::group::{group_name}")
+    yield
+    if ON_GHA:
+        print_line("::endgroup::")
+
+
+@contextmanager
+def GHAGroup(group_name: str, stage: str | None = None, cruise: str | None = None):
+    """A collapsible log group, also timed as stage (default the group name)
+
+    Stages recorded inside the group are labelled with cruise.
+    """
+    with (
+        _log_group(group_name),
+        labelled(cruise),
+        recorder.stage(stage or group_name, group=True),
+    ):
+        yield
+
+
+_local = threading.local()
+_output_lock = threading.Lock()
+
+
+class _BufferingFilter(logging.Filter):
+    def filter(self, record):
+        buffer = getattr(_local, "buffer", None)
+        if buffer is None:
+            return True
+        # the same record passes through every handler, only keep it once
+        if len(buffer) == 0 or buffer[-1] is not record:
+            buffer.append(record)
+        return False
+
+
+_buffering_filter = _BufferingFilter()
+
+
+@contextmanager
+def buffered_group(group_name: str, stage: str | None = None, cruise: str | None = None):
+    """GHAGroup for work running on a worker thread
+
+    Log records emitted by this thread are held back and written out together
+    when the block exits so groups from concurrent cruises do not interleave.
+    """
+    for handler in logging.getLogger().handlers:
+        if _buffering_filter not in handler.filters:
+            handler.addFilter(_buffering_filter)
+
+    _local.buffer = []
+    try:
+        with labelled(cruise), recorder.stage(stage or group_name, group=True):
+            yield
+    finally:
+        records, _local.buffer = _local.buffer, None
+        with _output_lock, _log_group(group_name):
+            for record in records:
+                logging.getLogger(record.name).handle(record)
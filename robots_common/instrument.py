@@ -0,0 +1,272 @@
+"""Per stage timing and resource use for a robot run.
+
+Stages are recorded with the wall time they took, the bytes they moved (when
+that makes sense) and the peak RSS of the process while they ran. Every
+GHAGroup is a stage, and finer stages (metadata fetch, CF download, dataset
+load, each conversion and upload) are recorded inside them, labelled with the
+cruise of the enclosing group.
+
+At the end of a run a JSON report is written and a summary table is added to
+the Github step summary.
+
+Stages timed in a worker process are collected and handed back with the
+result so the parent can keep them.
+"""
+
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+
+from . import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+REPORT_DIR = Path(os.environ.get("CCHDO_ROBOTS_REPORT_DIR", CACHE_DIR / "reports"))
+
+current_cruise: ContextVar[str | None] = ContextVar("current_cruise", default=None)
+_collecting: ContextVar[list | None] = ContextVar("collecting", default=None)
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def process_rss(pid="self") -> int | None:
+    """The RSS of process pid, None if it cannot be read (e.g. not linux)"""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return None
+
+
+def current_rss() -> int:
+    if (rss := process_rss()) is not None:
+        return rss
+    # not linux, the lifetime peak is the best there is
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def labelled(cruise: str | None):
+    """Label the stages recorded in this block with cruise"""
+    token = current_cruise.set(cruise)
+    try:
+        yield
+    finally:
+        current_cruise.reset(token)
+
+
+class Recorder:
+    """Collects stages, RSS is sampled on a background thread while any are open"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.stages: list[dict] = []
+        self._open: list[dict] = []
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                if len(self._open) == 0:
+                    self._sampler = None
+                    return
+                rss = current_rss()
+                for stage in self._open:
+                    stage["peak_rss"] = max(stage["peak_rss"], rss)
+            time.sleep(self.interval)
+
+    @contextmanager
+    def stage(self, name: str, format: str | None = None, **fields):
+        """Time the block as stage name, more fields (e.g. bytes) can be set on the yielded dict"""
+        stage = {
+            "stage": name,
+            "cruise": current_cruise.get(),
+            "format": format,
+            "seconds": 0.0,
+            "bytes": 0,
+            "peak_rss": current_rss(),
+            **fields,
+        }
+        with self._lock:
+            self._open.append(stage)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage["seconds"] = time.perf_counter() - start
+            with self._lock:
+                self._open.remove(stage)
+                stage["peak_rss"] = max(stage["peak_rss"], current_rss())
+            if (collected := _collecting.get()) is not None:
+                collected.append(stage)
+            else:
+                self.keep([stage])
+
+    @contextmanager
+    def collect(self):
+        """Yield a list the stages recorded in this block go to instead of the run"""
+        collected = []
+        token = _collecting.set(collected)
+        try:
+            yield collected
+        finally:
+            _collecting.reset(token)
+
+    def keep(self, stages: list[dict]):
+        """Add stages to the run, e.g. ones collected in a worker process"""
+        cruise = current_cruise.get()
+        with self._lock:
+            for stage in stages:
+                if stage["cruise"] is None:
+                    stage["cruise"] = cruise
+                self.stages.append(stage)
+
+    def reset(self):
+        """Forget the stages kept so far, e.g. between the cycles of a long running process"""
+        with self._lock:
+            self.stages = []
+
+    def report(self, robot: str, started: datetime, seconds: float) -> dict:
+        with self._lock:
+            stages = list(self.stages)
+        return {
+            "robot": robot,
+            "started": started.isoformat(),
+            "seconds": seconds,
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "totals": totals(stages),
+            "stages": stages,
+        }
+
+
+recorder = Recorder()
+
+
+def totals(stages: list[dict]) -> dict[str, dict]:
+    """Count, seconds, bytes and peak RSS of stages by stage (and format)"""
+    totals = defaultdict(lambda: {"count": 0, "seconds": 0.0, "bytes": 0, "peak_rss": 0})
+    for stage in stages:
+        key = stage["stage"]
+        if stage["format"] is not None:
+            key = f"{key} ({stage['format']})"
+        total = totals[key]
+        total["count"] += 1
+        total["seconds"] += stage["seconds"]
+        total["bytes"] += stage["bytes"]
+        total["peak_rss"] = max(total["peak_rss"], stage["peak_rss"])
+    return dict(totals)
+
+
+def merge_reports(reports: list[dict]) -> dict:
+    """One report for the shards of a run, failed if any shard failed"""
+    stages = [stage for report in reports for stage in report["stages"]]
+    return {
+        "robot": ", ".join(sorted({report["robot"] for report in reports})),
+        "started": min(report["started"] for report in reports),
+        # the shards ran side by side, the run took as long as the slowest
+        "seconds": max(report["seconds"] for report in reports),
+        "peak_rss": max(report["peak_rss"] for report in reports),
+        "shards": [report.get("shard") for report in reports],
+        "failed": any(report.get("failed", False) for report in reports),
+        "deferred": [c for report in reports for c in report.get("deferred", [])],
+        "totals": totals(stages),
+        "stages": stages,
+    }
+
+
+def step_summary(report: dict) -> str:
+    title = report["robot"]
+    if (shard := report.get("shard")) is not None:
+        title = f"{title} shard {shard[0]} of {shard[1]}"
+    status = "failed, " if report.get("failed", False) else ""
+    lines = [
+        f"### {title} run report",
+        "",
+        f"{status}Total {report['seconds']:.1f}s, peak RSS {report['peak_rss'] / 1024**2:.0f} MiB",
+        "",
+    ]
+    if deferred := report.get("deferred", []):
+        lines += [
+            f"{len(deferred)} cruises deferred to the next run: {', '.join(deferred)}",
+            "",
+        ]
+    lines += [
+        "| stage | count | seconds | MiB | peak RSS MiB |",
+        "| --- | ---: | ---: | ---: | ---: |",
+    ]
+    by_time = sorted(report["totals"].items(), key=lambda t: -t[1]["seconds"])
+    for name, total in by_time:
+        lines.append(
+            f"| {name} | {total['count']} | {total['seconds']:.1f} "
+            f"| {total['bytes'] / 1024**2:.2f} | {total['peak_rss'] / 1024**2:.0f} |"
+        )
+
+    slowest = sorted(
+        (
+            s
+            for s in report["stages"]
+            if s["cruise"] is not None and not s.get("group", False)
+        ),
+        key=lambda s: -s["seconds"],
+    )[:10]
+    if len(slowest) > 0:
+        lines += [
+            "",
+            "| slowest cruise stages | format | seconds | MiB |",
+            "| --- | --- | ---: | ---: |",
+        ]
+        for stage in slowest:
+            lines.append(
+                f"| {stage['cruise']}: {stage['stage']} | {stage['format'] or ''} "
+                f"| {stage['seconds']:.1f} | {stage['bytes'] / 1024**2:.2f} |"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def write_step_summary(report: dict):
+    if (summary := os.environ.get("GITHUB_STEP_SUMMARY")) is not None:
+        with open(summary, "a") as f:
+            f.write(step_summary(report))
+
+
+@contextmanager
+def run_report(robot: str, shard: tuple[int, int] | None = None):
+    """Write the JSON report and step summary for the run in this block, even if it exits
+
+    Set "failed" in the yielded dict if the run had errors, leaving the block with
+    an exception or a non zero exit also counts as failed.
+    """
+    started = datetime.now(tz=timezone.utc)
+    start = time.perf_counter()
+    outcome = {"failed": False}
+    try:
+        yield outcome
+    except SystemExit as err:
+        outcome["failed"] = outcome["failed"] or err.code not in (None, 0)
+        raise
+    except BaseException:
+        outcome["failed"] = True
+        raise
+    finally:
+        report = recorder.report(robot, started, time.perf_counter() - start)
+        report["shard"] = shard
+        report["failed"] = outcome["failed"]
+        report["deferred"] = outcome.get("deferred", [])
+        REPORT_DIR.mkdir(parents=True, exist_ok=True)
+        name = robot if shard is None else f"{robot}-shard{shard[0]}of{shard[1]}"
+        path = REPORT_DIR / f"{name}-{started.strftime('%Y%m%dT%H%M%SZ')}.json"
+        path.write_text(json.dumps(report, indent=2))
+        logger.info(f"Wrote run report to {path}")
+        write_step_summary(report)
@@ -0,0 +1,176 @@
+"""Conversions in supervised worker processes with time and memory limits.
+
+A pathological CF file can make a conversion hang or grow until the runner
+is out of memory. ``SupervisedPool`` is a stand in for the process pool that
+watches each task: if it runs past ``timeout`` seconds or its worker's RSS
+goes over ``max_rss`` bytes the worker is killed, the task fails with a
+``TaskKilled`` error and a fresh worker is started in its place so the
+following tasks run as before. A worker killed by the kernel (e.g. the OOM
+killer) fails its task the same way. Workers run ``initializer`` before they
+take a task, so imports are not counted against the time limit.
+"""
+
+import argparse
+import logging
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import get_context
+
+from .instrument import process_rss
+
+logger = logging.getLogger(__name__)
+
+_task_timeout = os.environ.get("CCHDO_TASK_TIMEOUT")
+_task_max_rss = os.environ.get("CCHDO_TASK_MAX_RSS")
+DEFAULT_TASK_TIMEOUT = None if _task_timeout is None else float(_task_timeout)
+DEFAULT_TASK_MAX_RSS = None if _task_max_rss is None else int(_task_max_rss)
+
+POLL_INTERVAL = 0.1
+
+
+class TaskKilled(Exception):
+    reason = "Worker died"
+
+
+class TaskTimeout(TaskKilled):
+    reason = "Conversion timed out"
+
+
+class TaskOutOfMemory(TaskKilled):
+    reason = "Conversion out of memory"
+
+
+def add_isolation_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--task-timeout",
+        type=float,
+        default=DEFAULT_TASK_TIMEOUT,
+        metavar="SECONDS",
+        help="run conversions in supervised processes and stop any taking longer than this",
+    )
+    parser.add_argument(
+        "--task-max-rss",
+        type=int,
+        default=DEFAULT_TASK_MAX_RSS,
+        metavar="BYTES",
+        help="run conversions in supervised processes and stop any using more memory than this",
+    )
+
+
+def _serve(conn, initializer):
+    if initializer is not None:
+        initializer()
+    conn.send("ready")
+    while (task := conn.recv()) is not None:
+        fn, args = task
+        try:
+            result = (True, fn(*args))
+        except Exception as err:
+            result = (False, err)
+        try:
+            conn.send(result)
+        except Exception as err:
+            # e.g. an exception that does not pickle
+            conn.send((False, RuntimeError(f"{type(err).__name__}: {err}")))
+
+
+class _Worker:
+    def __init__(self, ctx, initializer=None):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_serve, args=(child, initializer), daemon=True
+        )
+        self.process.start()
+        child.close()
+        self.ready = False
+
+    def wait_ready(self):
+        try:
+            self.ready = self.conn.recv() == "ready"
+        except EOFError:
+            raise self.died()
+
+    def died(self) -> TaskKilled:
+        self.process.join(1)
+        return TaskKilled(f"worker exited with code {self.process.exitcode}")
+
+    def rss(self) -> int:
+        return process_rss(self.process.pid) or 0
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(5)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class SupervisedPool:
+    """A pool of worker processes, submit returns a concurrent.futures.Future"""
+
+    def __init__(self, workers: int, timeout=None, max_rss=None, initializer=None):
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self.initializer = initializer
+        self._ctx = get_context("spawn")
+        self._idle = queue.SimpleQueue()
+        for _ in range(workers):
+            self._idle.put(_Worker(self._ctx, initializer))
+        # a thread per worker waits on it, so a task always finds one idle
+        self._threads = ThreadPoolExecutor(workers)
+
+    def submit(self, fn, *args):
+        return self._threads.submit(self._run, fn, args)
+
+    def _run(self, fn, args):
+        worker = self._idle.get()
+        try:
+            return self._supervise(worker, fn, args)
+        except TaskKilled as err:
+            logger.error(f"Killing conversion worker {worker.process.pid}: {err}")
+            worker.kill()
+            worker = _Worker(self._ctx, self.initializer)
+            raise
+        finally:
+            self._idle.put(worker)
+
+    def _supervise(self, worker, fn, args):
+        if not worker.ready:
+            worker.wait_ready()
+        worker.conn.send((fn, args))
+        start = time.monotonic()
+        while not worker.conn.poll(POLL_INTERVAL):
+            if not worker.process.is_alive():
+                raise worker.died()
+            elapsed = time.monotonic() - start
+            if self.timeout is not None and elapsed > self.timeout:
+                raise TaskTimeout(f"no result after {elapsed:.1f}s")
+            if self.max_rss is not None and (rss := worker.rss()) > self.max_rss:
+                raise TaskOutOfMemory(f"worker RSS {rss / 1024**2:.0f} MiB")
+        try:
+            ok, value = worker.conn.recv()
+        except EOFError:
+            raise worker.died()
+        if not ok:
+            raise value
+        return value
+
+    def shutdown(self):
+        self._threads.shutdown()
+        while not self._idle.empty():
+            self._idle.get().stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
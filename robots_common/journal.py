@@ -0,0 +1,190 @@
+"""Write-ahead journal of the API mutations a robot makes for each cruise.
+
+Before any request is made for a cruise its plan (the file records to
+upload and what they replace) is appended to the robot's journal and the
+files to upload are kept next to it. Each step (create, attach, merge ...)
+is appended once it has succeeded and the cruise is marked finished once
+they all have.
+
+If a run dies or a request fails, the next run replays the cruises that
+were not finished, skipping the steps that were done, without downloading
+or converting anything again. A replay is only tried once, if it fails too
+the cruise is planned from scratch as usual.
+
+A sharded run keeps its own journal and each plan records its shard, so a
+runner only ever replays the plans of its own shard.
+"""
+
+import json
+import logging
+import shutil
+import threading
+from pathlib import Path
+from uuid import uuid4
+
+from . import CACHE_DIR
+from .spool import Output
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_DIR = CACHE_DIR / "journal"
+
+
+class CruiseJournal:
+    """The steps of one cruise's plan"""
+
+    def __init__(self, journal: "Journal", plan_id: str, replaying=False):
+        self.journal = journal
+        self.plan_id = plan_id
+        self.replaying = replaying
+        self.done: dict[str, object] = {}
+
+    async def step(self, name: str, run):
+        """The result of awaiting run(), or of when it was done before
+
+        Only truthy results count as done.
+        """
+        if name in self.done:
+            logger.info(f"Skipping {name}, it was done by an earlier run")
+            return self.done[name]
+        if result := await run():
+            self.done[name] = result
+            self.journal._append(
+                {"event": "step", "plan": self.plan_id, "step": name, "result": result}
+            )
+        return result
+
+    def finish(self):
+        self.journal._append({"event": "finish", "plan": self.plan_id})
+
+    def abandon(self):
+        self.journal._append({"event": "abandon", "plan": self.plan_id})
+
+
+class _NoJournal:
+    replaying = False
+
+    async def step(self, name, run):
+        return await run()
+
+    def finish(self):
+        pass
+
+    def abandon(self):
+        pass
+
+
+NO_JOURNAL = _NoJournal()
+
+
+class Journal:
+    def __init__(self, robot: str, root: Path = JOURNAL_DIR, shard=None):
+        name = robot if shard is None else f"{robot}-shard{shard[0]}of{shard[1]}"
+        self.path = root / f"{name}.jsonl"
+        self.data_dir = root / name
+        self.shard = None if shard is None else list(shard)
+        self._lock = threading.Lock()
+        self._records: list[dict] = []
+        if self.path.exists():
+            for line in self.path.read_text().splitlines():
+                try:
+                    self._records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the run died part way through writing this line
+                    break
+
+    def _append(self, record: dict):
+        with self._lock:
+            self._records.append(record)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def _store(self, output: Output) -> Output:
+        """A copy of output in the journal that outlives the run"""
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        path = self.data_dir / output.file_hash
+        if not path.exists():
+            tmp = path.with_suffix(f".{uuid4().hex}.tmp")
+            if output.path is not None:
+                shutil.copyfile(output.path, tmp)
+            else:
+                tmp.write_bytes(output.data)
+            tmp.replace(path)
+        return Output(output.file_hash, output.size, path=path, temporary=False)
+
+    def begin(
+        self, expocode: str, plan: dict, outputs: dict[str, Output]
+    ) -> tuple[CruiseJournal, dict[str, Output]]:
+        """Journal the plan of a cruise before any of it is done
+
+        Returns the journal of the cruise's steps and the outputs as stored in the
+        journal, the originals can be discarded. Only pass the outputs a replay
+        has to upload.
+        """
+        stored = {key: self._store(output) for key, output in outputs.items()}
+        plan_id = uuid4().hex
+        self._append(
+            {
+                "event": "plan",
+                "plan": plan_id,
+                "expocode": expocode,
+                "shard": self.shard,
+                "outputs": {key: [o.file_hash, o.size] for key, o in stored.items()},
+                **plan,
+            }
+        )
+        return CruiseJournal(self, plan_id), stored
+
+    def unfinished(self) -> list[tuple[dict, CruiseJournal, dict[str, Output]]]:
+        """The latest plan of each cruise in this shard that was neither finished nor abandoned"""
+        with self._lock:
+            records = list(self._records)
+        latest = {}
+        closed = set()
+        done = {}
+        for record in records:
+            plan_id = record["plan"]
+            if record["event"] == "plan":
+                if record.get("shard") == self.shard:
+                    latest[record["expocode"]] = record
+            elif record["event"] == "step":
+                done.setdefault(plan_id, {})[record["step"]] = record["result"]
+            else:
+                closed.add(plan_id)
+
+        unfinished = []
+        for plan in latest.values():
+            if plan["plan"] in closed:
+                continue
+            cruise_journal = CruiseJournal(self, plan["plan"], replaying=True)
+            cruise_journal.done = done.get(plan["plan"], {})
+            outputs = {
+                key: Output(
+                    file_hash, size, path=self.data_dir / file_hash, temporary=False
+                )
+                for key, (file_hash, size) in plan["outputs"].items()
+            }
+            if all(output.path.exists() for output in outputs.values()):
+                unfinished.append((plan, cruise_journal, outputs))
+            else:
+                logger.warning(f"Files for the plan of {plan['expocode']} are gone")
+        return unfinished
+
+    def compact(self):
+        """Drop finished plans and files that no unfinished plan needs"""
+        unfinished = self.unfinished()
+        keep_plans = {plan["plan"] for plan, _, _ in unfinished}
+        keep_files = {o.file_hash for _, _, outputs in unfinished for o in outputs.values()}
+        with self._lock:
+            self._records = [r for r in self._records if r["plan"] in keep_plans]
+            if len(self._records) == 0:
+                self.path.unlink(missing_ok=True)
+            else:
+                tmp = self.path.with_suffix(".tmp")
+                tmp.write_text("".join(json.dumps(r) + "\n" for r in self._records))
+                tmp.replace(self.path)
+        if self.data_dir.exists():
+            for path in self.data_dir.iterdir():
+                if path.name not in keep_files:
+                    path.unlink(missing_ok=True)
@@ -0,0 +1,110 @@
+"""Logging setup shared by the robots.
+
+By default records are rendered by rich as they are logged. With
+``CCHDO_LOG_FORMAT=json`` they are instead put on a queue and written out as
+one JSON object per line by a background thread, to stdout or
+``CCHDO_LOG_FILE``, so a full catalogue run does not wait on its own log. In
+both modes records below ``CCHDO_LOG_LEVEL`` are dropped before anything is
+formatted.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from rich.logging import RichHandler
+
+from .instrument import current_cruise
+
+LOG_FORMAT = os.environ.get("CCHDO_LOG_FORMAT", "rich")
+LOG_LEVEL = os.environ.get("CCHDO_LOG_LEVEL")
+LOG_FILE = os.environ.get("CCHDO_LOG_FILE")
+
+_queue: queue.SimpleQueue | None = None
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        if getattr(record, "raw", False):
+            return record.msg
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.msg,
+        }
+        if (cruise := getattr(record, "cruise", None)) is not None:
+            entry["cruise"] = cruise
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _CruiseFilter(logging.Filter):
+    def filter(self, record):
+        # records held back by gha.buffered_group are handled again later,
+        # outside the cruise they were logged in
+        if not hasattr(record, "cruise"):
+            record.cruise = current_cruise.get()
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        """Only the message is merged here, the JSON is made on the listener thread"""
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = self.formatter.formatException(record.exc_info)
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        return record
+
+
+def setup_logging(console=None, level: str = "DEBUG"):
+    """Configure the root logger unless something (e.g. all_robots) already has"""
+    root = logging.getLogger()
+    if root.handlers:
+        return
+
+    if LOG_FORMAT != "json":
+        logging.basicConfig(
+            level=LOG_LEVEL or level,
+            format="%(message)s",
+            datefmt="[%X]",
+            handlers=[RichHandler(console=console)],
+        )
+        return
+
+    global _queue
+    _queue = queue.SimpleQueue()
+    handler = _QueueHandler(_queue)
+    handler.setFormatter(logging.Formatter())
+    handler.addFilter(_CruiseFilter())
+    root.addHandler(handler)
+    # high volume runs are what this is for, leave the debug lines out by default
+    root.setLevel(LOG_LEVEL or "INFO")
+
+    stream = open(LOG_FILE, "a", buffering=1) if LOG_FILE else sys.stdout
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JSONFormatter())
+    listener = QueueListener(_queue, output)
+    listener.start()
+    # registered after logging's own atexit hook, so runs before it
+    atexit.register(listener.stop)
+
+
+def print_line(line: str):
+    """Print line in order with the log records, e.g. the Github Actions group markers"""
+    if _queue is None:
+        print(line)
+    else:
+        _queue.put_nowait(logging.makeLogRecord({"msg": line, "raw": True}))
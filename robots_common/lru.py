@@ -0,0 +1,56 @@
+"""Least recently used eviction for the on disk caches.
+
+The caches keep one file per entry under ``root`` and record use by touching
+the file's mtime, so the oldest mtimes are evicted first once the entries
+add up to more than ``max_bytes``. Evictions run one at a time, the robots'
+threads may all be adding entries at once.
+"""
+
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+
+
+def entries(root: Path, pattern: str) -> list[tuple[Path, os.stat_result]]:
+    """The files under root matching pattern with their stat, skipping any just removed"""
+    if not root.exists():
+        return []
+    found = []
+    for path in root.glob(pattern):
+        try:
+            found.append((path, path.stat()))
+        except FileNotFoundError:
+            continue
+    return found
+
+
+def evict(
+    root: Path,
+    pattern: str,
+    max_bytes: int,
+    remove: Callable[[Path], None],
+    keep: Callable[[Path], bool] = lambda path: False,
+):
+    """remove the least recently used entries until the rest fit in max_bytes
+
+    The entries are the files under root matching pattern, those for which keep
+    is true are skipped.
+    """
+    with _lock:
+        found = sorted(entries(root, pattern), key=lambda e: e[1].st_mtime)
+        total = sum(stat.st_size for _, stat in found)
+        # always keep the most recent entry, it is the one just added or about to be used
+        for path, stat in found[:-1]:
+            if total <= max_bytes:
+                break
+            if keep(path):
+                continue
+            logger.debug(f"Evicting {path.name} from {path.parent.parent.name}")
+            remove(path)
+            total -= stat.st_size
@@ -0,0 +1,186 @@
+"""On disk snapshot of the cruise/all and file/all documents.
+
+Every robot needs the full cruise and file catalogue, these are large and
+are fetched several times each morning. The snapshot is reused without any
+request while it is younger than ``max_age`` seconds, after that it is
+revalidated using the ETag/Last-Modified validators the server sent last time.
+
+The file catalogue grows with the archive, so it is streamed to disk and
+parsed from there one record at a time into compact ``FileRecord``s rather
+than loaded whole.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+
+from . import CACHE_DIR, CCHDO_URL
+from .instrument import recorder
+from .records import FileRecord
+
+logger = logging.getLogger(__name__)
+
+METADATA_DIR = CACHE_DIR / "metadata"
+DEFAULT_MAX_AGE = int(os.environ.get("CCHDO_METADATA_MAX_AGE", 15 * 60))
+
+DOCUMENTS = {
+    "cruises": "/api/v1/cruise/all",
+    "files": "/api/v1/file/all",
+}
+
+# how the items of a document are kept, documents without one are loaded whole
+ITEMS = {
+    "files": FileRecord.from_json,
+}
+
+CHUNK_SIZE = 1024**2
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def _paths(name: str, cache_dir: Path) -> tuple[Path, Path]:
+    return cache_dir / f"{name}.json", cache_dir / f"{name}.meta.json"
+
+
+def _write_atomic(path: Path, data: bytes):
+    tmp = path.with_suffix(f"{path.suffix}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _read_meta(meta_path: Path) -> dict:
+    try:
+        return json.loads(meta_path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def iter_array(f, chunk_size=CHUNK_SIZE):
+    """The items of the JSON array in text file f, parsed one at a time"""
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+
+    def read_more():
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        eof = chunk == ""
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def next_char():
+        """The next non whitespace character, or "" at the end"""
+        nonlocal pos
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                return buf[pos : pos + 1]
+            read_more()
+
+    if next_char() != "[":
+        raise ValueError("expected a JSON array")
+    pos += 1
+    if next_char() == "]":
+        return
+    while True:
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            read_more()
+            continue
+        after = _WHITESPACE.match(buf, end).end()
+        if not eof and (after == len(buf) or buf[after] not in ",]"):
+            # a number may carry on in the next chunk
+            read_more()
+            continue
+        pos = end
+        yield item
+
+        if (char := next_char()) == "]":
+            return
+        if char != ",":
+            raise ValueError(f"expected , or ] in JSON array, got {char!r}")
+        pos += 1
+        next_char()
+
+
+def _read(name: str, body_path: Path):
+    if (item := ITEMS.get(name)) is None:
+        return json.loads(body_path.read_bytes())
+    with body_path.open(encoding="utf8") as f:
+        return [item(record) for record in iter_array(f)]
+
+
+def load_document(session, name, max_age=DEFAULT_MAX_AGE, cache_dir=METADATA_DIR):
+    """Load one of the DOCUMENTS, from the snapshot if it is still valid"""
+    body_path, meta_path = _paths(name, cache_dir)
+    meta = _read_meta(meta_path)
+    have_body = body_path.exists() and meta != {}
+
+    if have_body:
+        age = time.time() - meta.get("fetched_at", 0)
+        if age < max_age:
+            logger.info(f"Using {name} snapshot from {age:.0f}s ago")
+            return _read(name, body_path)
+
+    headers = {}
+    if have_body:
+        if (etag := meta.get("etag")) is not None:
+            headers["If-None-Match"] = etag
+        if (last_modified := meta.get("last_modified")) is not None:
+            headers["If-Modified-Since"] = last_modified
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = body_path.with_suffix(f"{body_path.suffix}.{os.getpid()}.tmp")
+    with recorder.stage("metadata", document=name) as stage:
+        with session.get(
+            f"{CCHDO_URL}{DOCUMENTS[name]}", headers=headers, stream=True
+        ) as r:
+            r.raise_for_status()
+            size = 0
+            if r.status_code != 304:
+                with tmp.open("wb") as f:
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        size += len(chunk)
+        stage["bytes"] = size
+
+    if r.status_code == 304:
+        logger.info(f"{name} snapshot revalidated, not modified")
+        meta["fetched_at"] = time.time()
+        _write_atomic(meta_path, json.dumps(meta).encode("utf8"))
+        return _read(name, body_path)
+
+    logger.info(f"Fetched {name}: {size} bytes")
+    os.replace(tmp, body_path)
+    meta = {
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "fetched_at": time.time(),
+    }
+    _write_atomic(meta_path, json.dumps(meta).encode("utf8"))
+    return _read(name, body_path)
+
+
+def load_cruises_and_files(session, max_age=DEFAULT_MAX_AGE, cache_dir=METADATA_DIR):
+    cruises = load_document(session, "cruises", max_age=max_age, cache_dir=cache_dir)
+    files = load_document(session, "files", max_age=max_age, cache_dir=cache_dir)
+    return cruises, files
+
+
+def invalidate(cache_dir=METADATA_DIR):
+    """Force the next load to revalidate with the server
+
+    Call this after making changes to cruises or files so the next robot
+    does not skip the request because of max_age. The validators are kept
+    so it is still a cheap conditional request if nothing else changed.
+    """
+    for name in DOCUMENTS:
+        _, meta_path = _paths(name, cache_dir)
+        if (meta := _read_meta(meta_path)) != {}:
+            meta["fetched_at"] = 0
+            _write_atomic(meta_path, json.dumps(meta).encode("utf8"))
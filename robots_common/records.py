@@ -0,0 +1,65 @@
+"""Compact records of the file/all catalogue.
+
+The file catalogue has an entry for every file in the archive, each with many
+more fields (submissions, events, permissions ...) than the robots use. Only
+the fields in ``FILE_FIELDS`` are kept, in a slotted record that reads like
+the dict it came from. The strings repeated across the archive are interned.
+"""
+
+import sys
+
+FILE_FIELDS = (
+    "id",
+    "role",
+    "data_type",
+    "data_format",
+    "file_hash",
+    "file_path",
+    "file_name",
+    "file_sources",
+    "cruises",
+    "file_size",
+)
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class FileRecord:
+    __slots__ = FILE_FIELDS
+
+    def __init__(self, **fields):
+        for name in FILE_FIELDS:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_json(cls, record: dict) -> "FileRecord":
+        self = cls.__new__(cls)
+        get = record.get
+        self.id = get("id")
+        self.role = _intern(get("role"))
+        self.data_type = _intern(get("data_type"))
+        self.data_format = _intern(get("data_format"))
+        self.file_hash = get("file_hash")
+        self.file_path = get("file_path")
+        self.file_name = get("file_name")
+        self.file_sources = tuple(get("file_sources") or ())
+        self.cruises = tuple(get("cruises") or ())
+        self.file_size = get("file_size")
+        return self
+
+    def __getitem__(self, name):
+        if name not in FILE_FIELDS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in FILE_FIELDS else default
+
+    def as_dict(self) -> dict:
+        """A plain dict of the record, e.g. to write it out as JSON"""
+        return {name: getattr(self, name) for name in FILE_FIELDS}
+
+    def __repr__(self):
+        return f"FileRecord(id={self.id!r}, file_path={self.file_path!r})"
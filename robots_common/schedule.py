@@ -0,0 +1,199 @@
+"""Ordering the planned cruises and fitting them into a run's budgets.
+
+Cruises are run newest CF file first (file ids only go up, so the highest id
+is the most recent change). With a time budget a cruise is only started if
+its estimated time, from the size of its CF file and how fast the cruises so
+far this run went, fits in the time left. The uploads that carry on after
+a cruise is processed are timed too, the cruise and its uploads have to fit
+and so do the uploads already in flight, so the run does not end up waiting
+on uploads past its budget. Cruises that do not fit are deferred to the
+next run, smaller ones after them may still fit, and nothing is stopped
+part way through. With a memory budget cruises only run at the same time
+while their estimated memory fits in it.
+"""
+
+import argparse
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from .gha import GHAGroup
+
+logger = logging.getLogger(__name__)
+
+_time_budget = os.environ.get("CCHDO_TIME_BUDGET")
+_memory_budget = os.environ.get("CCHDO_MEMORY_BUDGET")
+DEFAULT_TIME_BUDGET = None if _time_budget is None else float(_time_budget)
+DEFAULT_MEMORY_BUDGET = None if _memory_budget is None else int(_memory_budget)
+
+# a CF file is compressed, loaded and converted to several formats it takes
+# a few times its size
+MEMORY_PER_CF_BYTE = 4
+
+# before any cruise has been timed this run, counts as this many bytes timed
+PRIOR_SECONDS_PER_BYTE = 1 / (2 * 1024**2)
+PRIOR_BYTES = 16 * 1024**2
+
+
+def cf_size(cf_file) -> int:
+    return cf_file.get("file_size") or 0
+
+
+def newest_first(items, cf_file) -> list:
+    """items ordered by how recently their CF file changed, cf_file is a function of an item"""
+    return sorted(items, key=lambda item: -(cf_file(item)["id"] or 0))
+
+
+def add_schedule_arguments(parser: argparse.ArgumentParser, memory=True):
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=DEFAULT_TIME_BUDGET,
+        metavar="SECONDS",
+        help="defer cruises that would not finish within this many seconds of the start",
+    )
+    if memory:
+        parser.add_argument(
+            "--memory-budget",
+            type=int,
+            default=DEFAULT_MEMORY_BUDGET,
+            metavar="BYTES",
+            help="only run cruises at the same time while their estimated memory fits",
+        )
+
+
+class Slot:
+    """What Scheduler.run yields, false if the cruise was deferred"""
+
+    def __init__(self, admitted: bool):
+        self.admitted = admitted
+        self.future: Future | None = None
+
+    def __bool__(self):
+        return self.admitted
+
+    def until(self, future: Future | None) -> Future | None:
+        """Count the cruise as running until future (e.g. its uploads) is done"""
+        self.future = future
+        return future
+
+
+class Scheduler:
+    def __init__(self, time_budget=None, memory_budget=None):
+        self.time_budget = time_budget
+        self.memory_budget = memory_budget
+        self.started = time.monotonic()
+        self.deferred: list[str] = []
+        self._cond = threading.Condition()
+        self._in_use = 0
+        # cruises get their memory in the order they asked for it
+        self._next_ticket = 0
+        self._serving = 0
+        self._timed_bytes = 0
+        self._timed_seconds = 0.0
+        # when each cruise still uploading started to, by slot
+        self._uploading: dict[int, float] = {}
+        self._uploads = 0
+        self._upload_seconds = 0.0
+
+    def estimate(self, size: int) -> float:
+        """Estimated seconds to process a cruise with a CF file of size bytes"""
+        with self._cond:
+            seconds = self._timed_seconds + PRIOR_SECONDS_PER_BYTE * PRIOR_BYTES
+            return size * seconds / (self._timed_bytes + PRIOR_BYTES)
+
+    def upload_estimate(self) -> float:
+        """Estimated seconds from the end of a cruise's processing until its uploads are done
+
+        Until an upload has finished this is how long the oldest one has taken so far.
+        """
+        now = time.monotonic()
+        with self._cond:
+            if self._uploads > 0:
+                return self._upload_seconds / self._uploads
+            return max((now - start for start in self._uploading.values()), default=0.0)
+
+    def uploads_left(self) -> float:
+        """Estimated seconds until the uploads in flight are done"""
+        now = time.monotonic()
+        expected = self.upload_estimate()
+        with self._cond:
+            started = list(self._uploading.values())
+        return max((expected - (now - start) for start in started), default=0.0)
+
+    def time_left(self) -> float | None:
+        if self.time_budget is None:
+            return None
+        return self.time_budget - (time.monotonic() - self.started)
+
+    def _uploaded(self, slot_id: int):
+        with self._cond:
+            self._upload_seconds += time.monotonic() - self._uploading.pop(slot_id)
+            self._uploads += 1
+
+    @contextmanager
+    def run(self, expocode: str, size: int):
+        """Wait for memory for a cruise, yields a Slot that is false if it is deferred
+
+        The cruise holds its memory for the block and the block is timed to
+        refine the estimates. The uploads given to the Slot are timed too, a
+        cruise is deferred if it and its uploads, or the uploads already in
+        flight, would not be done within the time budget.
+        """
+        memory = size * MEMORY_PER_CF_BYTE
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            # a cruise bigger than the budget still runs, on its own
+            self._cond.wait_for(
+                lambda: self._serving == ticket
+                and (
+                    self.memory_budget is None
+                    or self._in_use == 0
+                    or self._in_use + memory <= self.memory_budget
+                )
+            )
+            self._serving += 1
+            self._in_use += memory
+            self._cond.notify_all()
+
+        try:
+            left = self.time_left()
+            needed = max(
+                self.estimate(size) + self.upload_estimate(), self.uploads_left()
+            )
+            if left is not None and needed > left:
+                logger.warning(
+                    f"Deferring {expocode}, estimated {needed:.1f}s with {max(left, 0):.1f}s left"
+                )
+                with self._cond:
+                    self.deferred.append(expocode)
+                yield Slot(False)
+                return
+
+            slot = Slot(True)
+            start = time.monotonic()
+            yield slot
+            with self._cond:
+                self._timed_seconds += time.monotonic() - start
+                self._timed_bytes += size
+                if slot.future is not None:
+                    self._uploading[id(slot)] = time.monotonic()
+            if slot.future is not None:
+                slot.future.add_done_callback(lambda _: self._uploaded(id(slot)))
+        finally:
+            with self._cond:
+                self._in_use -= memory
+                self._cond.notify_all()
+
+    def report(self):
+        if len(self.deferred) == 0:
+            return
+        with GHAGroup(f"Deferred cruises ({len(self.deferred)})"):
+            logger.warning(
+                f"{len(self.deferred)} cruises did not fit in the time budget, they are left for the next run"
+            )
+            logger.info(self.deferred)
@@ -0,0 +1,72 @@
+"""Splitting the planned cruises of a run between several runners.
+
+``--shard INDEX/COUNT`` (1 based) makes a runner do only its part of the
+planned work. By default cruises are assigned by a stable hash of their
+expocode, which every runner agrees on even if their catalogues were
+loaded a little apart. ``--shard-by size`` instead balances the CF file
+sizes of the planned work between the shards, this needs every runner to
+plan the same work.
+"""
+
+import argparse
+from hashlib import sha256
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected INDEX/COUNT, got {value!r}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard index must be from 1 to {count}")
+    return index, count
+
+
+def add_shard_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="INDEX/COUNT",
+        help="only do this share of the planned cruises, e.g. 1/4",
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=["expocode", "size"],
+        default="expocode",
+        help="assign cruises to shards by expocode hash or balance CF file sizes",
+    )
+
+
+def expocode_shard(expocode: str, count: int) -> int:
+    """The 1 based shard of expocode, the same on every machine and run"""
+    digest = sha256(expocode.encode("utf8")).digest()
+    return int.from_bytes(digest[:8], "big") % count + 1
+
+
+def select_shard(items, shard, expocode, size=None, by="expocode") -> list:
+    """The items in shard, in their original order
+
+    expocode and size are functions of an item, size is only needed to
+    shard by size.
+    """
+    items = list(items)
+    if shard is None:
+        return items
+    index, count = shard
+    if by == "expocode":
+        return [item for item in items if expocode_shard(expocode(item), count) == index]
+
+    # largest first to the least loaded shard, ties broken by expocode and shard
+    loads = [0] * count
+    selected = set()
+    order = sorted(range(len(items)), key=lambda i: (-size(items[i]), expocode(items[i])))
+    for i in order:
+        target = min(range(count), key=lambda s: (loads[s], s))
+        loads[target] += size(items[i])
+        if target == index - 1:
+            selected.add(i)
+    return [item for i, item in enumerate(items) if i in selected]
+
+
+def describe(shard) -> str:
+    return "" if shard is None else f"shard {shard[0]} of {shard[1]}"
@@ -0,0 +1,57 @@
+"""Conversion outputs spooled to disk when they are large.
+
+CTD conversions are zip archives of every station and can be very large. A
+cruise's outputs are kept until its uploads finish, and several cruises can
+be waiting on uploads at once, so anything over ``SPOOL_THRESHOLD`` is
+written to a file straight after the conversion and read back a chunk at a
+time by the uploader. In a worker process only the path then needs to be
+sent back.
+"""
+
+import io
+import os
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO
+
+from .upload import hash_and_size
+
+SPOOL_DIR = Path(
+    os.environ.get("CCHDO_SPOOL_DIR", Path(tempfile.gettempdir()) / "cchdo-robots")
+)
+SPOOL_THRESHOLD = int(os.environ.get("CCHDO_SPOOL_THRESHOLD", 16 * 1024**2))
+
+
+@dataclass
+class Output:
+    file_hash: str
+    size: int
+    data: bytes | None = None
+    path: Path | None = None
+    # spooled files are removed by discard, others belong to someone else
+    temporary: bool = True
+
+    @classmethod
+    def spool(cls, data: bytes, name: str = "", threshold=SPOOL_THRESHOLD) -> "Output":
+        file_hash, size = hash_and_size(data)
+        if size <= threshold:
+            return cls(file_hash, size, data=data)
+        SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix=f"_{name}", dir=SPOOL_DIR)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return cls(file_hash, size, path=Path(path))
+
+    @property
+    def source(self) -> bytes | Path:
+        """What to hand to JSONUpload"""
+        return self.data if self.path is None else self.path
+
+    def open(self) -> BinaryIO:
+        return io.BytesIO(self.data) if self.path is None else self.path.open("rb")
+
+    def discard(self):
+        """Remove the spooled file, once the output is no longer needed"""
+        if self.path is not None and self.temporary:
+            self.path.unlink(missing_ok=True)
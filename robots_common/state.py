@@ -0,0 +1,78 @@
+"""Per cruise record of what the robots last did, for incremental runs.
+
+For each task (trackline, sumfile, bottle, ctd) and cruise this keeps the
+file_hash of the CF file and the cchdo.hydro version that were last processed
+successfully. The derived file robots also keep the ids and hashes of the
+cruise's dataset files, cruises whose CF file and dataset files match the
+record can be skipped when planning. The trackline and sumfile robots keep a
+hash of what they made, so it is only regenerated when its source CF file
+changes while it is still the cruise's current one. Running with ``full``
+ignores the record for skipping but still updates it.
+"""
+
+import json
+import logging
+import os
+import threading
+from importlib.metadata import version
+
+from . import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+STATE_PATH = CACHE_DIR / "state.json"
+
+HYDRO_VERSION = version("cchdo.hydro")
+
+
+class RunState:
+    def __init__(self, path=STATE_PATH, full=False):
+        self.path = path
+        self.full = full
+        self._lock = threading.Lock()
+        try:
+            self.tasks = json.loads(path.read_text())
+        except FileNotFoundError:
+            self.tasks = {}
+        except json.JSONDecodeError:
+            logger.warning(f"Could not read {path}, starting with an empty state")
+            self.tasks = {}
+
+    def _current(self, cf_file, files=None):
+        current = {"cf_hash": cf_file["file_hash"], "hydro_version": HYDRO_VERSION}
+        if files is not None:
+            current["files"] = sorted([file["id"], file["file_hash"]] for file in files)
+        return current
+
+    def previous(self, task, expocode) -> dict | None:
+        return self.tasks.get(task, {}).get(expocode)
+
+    def unchanged(self, task, expocode, cf_file, files=None) -> bool:
+        """True if task was already done for this exact CF file, files and cchdo.hydro version"""
+        if self.full:
+            return False
+        return self.previous(task, expocode) == self._current(cf_file, files)
+
+    def source_changed(self, task, expocode, cf_file) -> bool:
+        """True if task was done before but from a different CF file"""
+        if cf_file is None or (previous := self.previous(task, expocode)) is None:
+            return False
+        return previous["cf_hash"] != cf_file["file_hash"]
+
+    def made(self, task, expocode) -> str | None:
+        """The hash of what task last made for the cruise, e.g. its sumfile"""
+        return (self.previous(task, expocode) or {}).get("made")
+
+    def record(self, task, expocode, cf_file, files=None, made=None):
+        current = self._current(cf_file, files)
+        if made is not None:
+            current["made"] = made
+        with self._lock:
+            self.tasks.setdefault(task, {})[expocode] = current
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with self._lock:
+            tmp.write_text(json.dumps(self.tasks))
+        os.replace(tmp, self.path)
@@ -0,0 +1,111 @@
+"""Simplifying cruise tracks before they are sent to the website.
+
+Cruises with many stations give large LineStrings that are slow to upload,
+store and draw on the map. ``simplify_track`` keeps a subset of the
+vertices using Douglas-Peucker, adding the vertex furthest from the
+simplified line first until every dropped vertex is within ``tolerance``
+degrees of it or ``max_vertices`` are kept.
+
+Vertices are kept in station order and the two ends of every dateline
+crossing are always kept so the track still crosses at the same place.
+numpy is only imported once a track is simplified, planning does not need it.
+"""
+
+import heapq
+import json
+import os
+from hashlib import sha256
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+
+_tolerance = os.environ.get("CCHDO_TRACK_TOLERANCE")
+_max_vertices = os.environ.get("CCHDO_TRACK_MAX_VERTICES")
+DEFAULT_TOLERANCE = float(_tolerance) if _tolerance else None
+DEFAULT_MAX_VERTICES = int(_max_vertices) if _max_vertices else None
+
+
+def _unwrap(lon: "np.ndarray") -> "np.ndarray":
+    """lon without the 360 degree jumps at the dateline"""
+    import numpy as np
+
+    shifts = -360 * np.round(np.diff(lon) / 360)
+    return lon + np.concatenate(([0], np.cumsum(shifts)))
+
+
+def _furthest(points: "np.ndarray", start: int, end: int) -> tuple[float, int]:
+    """The distance and index of the point between start and end furthest from the line joining them"""
+    import numpy as np
+
+    a = points[start]
+    d = points[end] - a
+    rel = points[start + 1 : end] - a
+    if (norm := np.hypot(*d)) == 0:
+        dist = np.hypot(rel[:, 0], rel[:, 1])
+    else:
+        dist = np.abs(d[0] * rel[:, 1] - d[1] * rel[:, 0]) / norm
+    i = int(np.argmax(dist))
+    return float(dist[i]), start + 1 + i
+
+
+def simplified_indices(
+    coords: "np.ndarray", tolerance: float | None = None, max_vertices: int | None = None
+) -> "np.ndarray":
+    """The sorted indices of the (lon, lat) coords to keep"""
+    import numpy as np
+
+    n = len(coords)
+    points = np.column_stack((_unwrap(coords[:, 0]), coords[:, 1]))
+
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n - 1]] = True
+    crossings = np.flatnonzero(np.abs(np.diff(coords[:, 0])) > 180)
+    keep[crossings] = True
+    keep[crossings + 1] = True
+
+    heap = []
+
+    def push(start, end):
+        if end - start > 1:
+            dist, i = _furthest(points, start, end)
+            heapq.heappush(heap, (-dist, i, start, end))
+
+    fixed = np.flatnonzero(keep)
+    for start, end in zip(fixed[:-1], fixed[1:]):
+        push(start, end)
+
+    kept = len(fixed)
+    while len(heap) > 0:
+        if max_vertices is not None and kept >= max_vertices:
+            break
+        neg_dist, i, start, end = heapq.heappop(heap)
+        if tolerance is not None and -neg_dist <= tolerance:
+            break
+        keep[i] = True
+        kept += 1
+        push(start, i)
+        push(i, end)
+
+    return np.flatnonzero(keep)
+
+
+def simplify_track(
+    track: dict, tolerance: float | None = None, max_vertices: int | None = None
+) -> dict:
+    """track (a GeoJSON LineString) with fewer vertices, unchanged if neither limit is given"""
+    import numpy as np
+
+    if tolerance is None and max_vertices is None:
+        return track
+    coords = np.asarray(track["coordinates"], dtype=float)
+    keep = simplified_indices(coords, tolerance, max_vertices)
+    return {**track, "coordinates": coords[keep].tolist()}
+
+
+def track_digest(track: dict) -> str:
+    """A hash of track, coordinates are rounded so it survives a round trip through the API"""
+    coordinates = [
+        [round(value, 6) for value in point] for point in track.get("coordinates", [])
+    ]
+    return sha256(json.dumps(coordinates).encode("utf8")).hexdigest()
@@ -6,57 +6,52 @@
 #     "rich",
 # ]
 # ///
-from tempfile import NamedTemporaryFile
+import argparse
 import logging
-from functools import partial
-from base64 import b64encode
+from concurrent.futures import Future
 from datetime import datetime, timezone
-from hashlib import sha256
-import os
-from contextlib import contextmanager
+import sys
+from pathlib import Path
 
-import xarray as xr
-from rich.logging import RichHandler
 from rich.console import Console
 
-import cchdo.hydro.accessors  # noqa
 from cchdo.auth.session import session as s
 
-ON_GHA = "GITHUB_RUN_ID" in os.environ
-
-if ON_GHA:
-    # closes the group started by the calling run line
-    # This group is for the uv installs
-    print("::endgroup::")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from robots_common import metadata  # noqa: E402
+from robots_common.api import api_for, succeeded  # noqa: E402
+from robots_common.catalogue import load_catalogue  # noqa: E402
+from robots_common.cf_cache import cf_cache  # noqa: E402
+from robots_common.datasets import load_cf  # noqa: E402
+from robots_common.shard import add_shard_arguments, describe, select_shard  # noqa: E402
+from robots_common.spool import Output  # noqa: E402
+from robots_common.state import RunState  # noqa: E402
+from robots_common.upload import JSON_HEADERS, JSONUpload, hash_and_size  # noqa: E402
+from robots_common.gha import GHAGroup, close_install_group  # noqa: E402
+from robots_common.instrument import recorder, run_report  # noqa: E402
+from robots_common.journal import NO_JOURNAL, Journal  # noqa: E402
+from robots_common.logs import setup_logging  # noqa: E402
+from robots_common.schedule import (  # noqa: E402
+    Scheduler,
+    add_schedule_arguments,
+    cf_size,
+    newest_first,
+)
 
 console = Console(color_system="256")
 
 logger = logging.getLogger(__name__)
 
-FORMAT = "%(message)s"
-logging.basicConfig(
-    level="NOTSET",
-    format=FORMAT,
-    datefmt="[%X]",
-    handlers=[RichHandler(console=console)],
-)
-
-
-@contextmanager
-def GHAGroup(group_name: str):
-    if ON_GHA:
-        print(f"::group::{group_name}")
-    yield
-    if ON_GHA:
-        print("::endgroup::")
+setup_logging(console, level="NOTSET")
 
 
 def make_cchdo_file_record(sumfile, fname, file_context):
+    """The file record for sumfile, its body is added by JSONUpload when it is sent"""
+    file_hash, file_size = hash_and_size(sumfile)
     return {
         "file": {
             "type": "text/plain",
             "name": fname,
-            "body": b64encode(sumfile).decode("ascii"),
         },
         "container_contents": [],
         "data_container": "",
@@ -72,10 +67,10 @@ def make_cchdo_file_record(sumfile, fname, file_context):
                 "type": "Generated",
             }
         ],
-        "file_hash": sha256(sumfile).hexdigest(),
+        "file_hash": file_hash,
         "file_name": fname,
         "file_path": "",
-        "file_size": len(sumfile),
+        "file_size": file_size,
         "file_sources": [],
         "file_type": "text/plain",
         "other_roles": [],
@@ -85,120 +80,350 @@ def make_cchdo_file_record(sumfile, fname, file_context):
     }
 
 
-def has_no_sumfile(cruise, files) -> bool:
-    for file in cruise["files"]:
-        if (fmeta := files.get(file)) is not None:
-            if fmeta["role"] == "dataset" and fmeta["data_type"] == "summary":
-                return False
+def gen_merge_patch():
+    return [
+        {
+            "path": "/events/0",
+            "op": "add",
+            "value": {
+                "date": datetime.now(tz=timezone.utc)
+                .isoformat()
+                .replace("+00:00", "Z"),
+                "name": "CCHDO Website Robot",
+                "notes": "The CF source file was updated so this sumfile was regenerated",
+                "type": "Replaced",
+            },
+        },
+        {"path": "/role", "op": "replace", "value": "merged"},
+    ]
+
+
+def has_no_sumfile(cruise, catalogue) -> bool:
+    return len(catalogue.find(cruise, "dataset", "summary")) == 0
+
+
+def robot_sumfiles(cruise, catalogue, state) -> list:
+    """The cruise's sumfiles if they are all the one this robot last made, otherwise none"""
+    sumfiles = catalogue.find(cruise, "dataset", "summary")
+    made = state.made("sumfile", cruise["expocode"])
+    if made is None or any(file["file_hash"] != made for file in sumfiles):
+        return []
+    return sumfiles
+
+
+def plan_sumfiles(catalogue, state):
+    """The (cruise, cf_file) pairs to make sumfiles for and the expocodes that cannot have one
+
+    Besides cruises without a sumfile this includes cruises whose sumfile was
+    made by this robot from a CF file that has since changed, as long as no
+    other sumfile has been added since.
+    """
+    cruises_no_sum = []
+    cruises_outdated = []
+    for cruise in catalogue.cruises:
+        if has_no_sumfile(cruise, catalogue):
+            cruises_no_sum.append(cruise)
+        elif state.source_changed(
+            "sumfile", cruise["expocode"], catalogue.cf_file(cruise)
+        ) and robot_sumfiles(cruise, catalogue, state):
+            cruises_outdated.append(cruise)
+    logger.info(
+        f"{len(cruises_no_sum)} of {len(catalogue.cruises)} cruises have no sumfile"
+    )
+    logger.info(f"{len(cruises_outdated)} cruises have a sumfile from an old CF file")
+
+    work = []
+    cannot_do = []
+    for cruise in [*cruises_no_sum, *cruises_outdated]:
+        if (cf_file := catalogue.cf_file(cruise)) is None:
+            cannot_do.append(cruise["expocode"])
+            continue
+        work.append((cruise, cf_file))
+    return work, cannot_do
+
+
+def add_sumfile(cruise, cf_file, df, catalogue, state, journal=None) -> Future:
+    """Generate the sumfile for cruise and submit its upload
+
+    The returned future is False if any request failed. With a journal the
+    upload is journaled first so a later run can finish it.
+    """
+    with recorder.stage("to_sum") as stage:
+        sumfile = df.cchdo.to_sum()
+        stage["bytes"] = len(sumfile)
+    logger.debug("Generated sumfile: \n %s[...]", sumfile[:1000].decode("utf8", "replace"))
+
+    submission = make_cchdo_file_record(
+        sumfile, f"{cruise['expocode']}su.txt", cf_file
+    )
+    output = Output.spool(sumfile)
+    existing = catalogue.file_by_hash.get(submission["file_hash"])
+    existing_id = None if existing is None else existing["id"]
+    replaces = [file["id"] for file in robot_sumfiles(cruise, catalogue, state)]
+
+    cruise_journal = NO_JOURNAL
+    if journal is not None:
+        plan = {
+            "cruise_id": cruise["id"],
+            "cf_file": cf_file.as_dict(),
+            "record": submission,
+            "existing_id": existing_id,
+            "replaces": replaces,
+        }
+        # an existing sumfile is only reactivated, there is nothing to upload
+        outputs = {} if existing_id is not None else {"sumfile": output}
+        cruise_journal, stored = journal.begin(cruise["expocode"], plan, outputs)
+        output = stored.get("sumfile", output)
+
+    return api_for(s).submit(
+        upload_sumfile(
+            cruise,
+            cf_file,
+            output,
+            submission,
+            existing_id,
+            replaces,
+            catalogue,
+            state,
+            cruise_journal,
+        )
+    )
+
+
+def resume_unfinished(journal, catalogue, state) -> int:
+    """Finish the journaled uploads an earlier run did not, returns how many cruises there were"""
+    unfinished = journal.unfinished()
+    for plan, cruise_journal, outputs in unfinished:
+        if (cruise := catalogue.cruise_by_id.get(plan["cruise_id"])) is None:
+            cruise_journal.abandon()
+            continue
+        logger.info(f"Resuming the unfinished sumfile upload of {plan['expocode']}")
+        api_for(s).submit(
+            upload_sumfile(
+                cruise,
+                plan["cf_file"],
+                outputs.get("sumfile"),
+                plan["record"],
+                plan["existing_id"],
+                plan["replaces"],
+                catalogue,
+                state,
+                cruise_journal,
+            )
+        )
+    api_for(s).wait()
+    return len(unfinished)
+
+
+async def upload_sumfile(
+    cruise,
+    cf_file,
+    output,
+    submission,
+    existing_id,
+    replaces,
+    catalogue,
+    state,
+    journal=NO_JOURNAL,
+) -> bool:
+    """Upload and attach the sumfile for cruise, False if any request failed
+
+    The replaces files are marked as merged, these are the sumfiles this robot
+    made from an older CF file (see robot_sumfiles). A failed replay of a
+    journaled upload is abandoned, the cruise will be planned again.
+    """
+    uploaded = False
+    try:
+        uploaded = await sumfile_steps(
+            cruise, output, submission, existing_id, replaces, catalogue, journal
+        )
+    finally:
+        if uploaded:
+            journal.finish()
+        elif journal.replaying:
+            journal.abandon()
+    if not uploaded:
+        return False
+
+    logger.info(
+        f"Cruise {cruise['expocode']} updated with sumfile from {cf_file['file_path']}"
+    )
+    state.record("sumfile", cruise["expocode"], cf_file, made=submission["file_hash"])
     return True
 
 
-def is_cf_netcdf_dataset(file) -> bool:
-    is_cf = file["data_format"] == "cf_netcdf"
-    is_dataset = file["role"] == "dataset"
-    return is_cf and is_dataset
-
-
-def cruise_add_sumfile_from_cf():
-    with GHAGroup("Load Cruise and File Metadata"):
-        logger.info("Loading Cruise and File information")
-        cruises = s.get("https://cchdo.ucsd.edu/api/v1/cruise/all").json()
-        files = s.get("https://cchdo.ucsd.edu/api/v1/file/all").json()
-
-        file_by_id = {file["id"]: file for file in files}
-        file_by_hash = {file["file_hash"]: file for file in files}
+async def sumfile_steps(
+    cruise, output, submission, existing_id, replaces, catalogue, journal
+) -> bool:
+    api = api_for(s)
+    if existing_id is not None:
+        id_ = existing_id
+        patch = [
+            {"op": "replace", "path": "/role", "value": "dataset"},
+            {"op": "replace", "path": "/data_format", "value": "woce"},
+            {"op": "replace", "path": "/data_format", "value": "woce"},
+            {"op": "replace", "path": "/data_type", "value": "summary"},
+            {"op": "replace", "path": "/file_type", "value": "text/plain"},
+            {
+                "op": "replace",
+                "path": "/file_name",
+                "value": submission["file_name"],
+            },
+        ]
+
+        async def reactivate():
+            r = await api.post(f"/api/v1/file/{id_}", idempotent=True)
+            if not r.ok:
+                logger.critical(f"Could not reactivate file {id_}")
+                return False
+            r = await api.patch(f"/api/v1/file/{id_}", json=patch, idempotent=True)
+            if not r.ok:
+                logger.critical(f"Could not patch file {id_}")
+                return False
+            return True
+
+        if not await journal.step("reactivate", reactivate):
+            return False
+
+    else:
+
+        async def create():
+            if journal.replaying:
+                # an earlier run may have created it but died before journaling that
+                if (file := catalogue.file_by_hash.get(submission["file_hash"])) is not None:
+                    return str(file["id"])
+            with recorder.stage("upload", bytes=submission["file_size"]):
+                r = await api.post(
+                    "/api/v1/file",
+                    data=JSONUpload(submission, output.source, output.size),
+                    headers=JSON_HEADERS,
+                )
 
-        ffunc = partial(has_no_sumfile, files=file_by_id)
+            if not r.ok:
+                logger.critical("Could not create sumfile")
+                return None
 
-        cruises_no_sum = list(filter(ffunc, cruises))
-        logger.info(f"{len(cruises_no_sum)} of {len(cruises)} cruises have no sumfile")
+            return r.json()["message"].split("/")[-1]
 
-    cannot_do = []
-    for cruise in cruises_no_sum:
-        cf_file = None
-        for file_id in cruise["files"]:
-            try:
-                file = file_by_id[file_id]
-            except KeyError:
-                continue
+        if (id_ := await journal.step("create", create)) is None:
+            return False
 
-            if not is_cf_netcdf_dataset(file):
-                continue
+    async def attach():
+        r = await api.post(
+            f"/api/v1/cruise/{cruise['id']}/files/{id_}", idempotent=True
+        )
+        if not r.ok:
+            logger.critical("Error patching cruise")
+        return r.ok
 
-            cf_file = file
-            break
+    if not await journal.step("attach", attach):
+        return False
 
-        if cf_file is None:
-            cannot_do.append(cruise["expocode"])
+    for old_id in replaces:
+        if str(old_id) == str(id_):
             continue
 
-        file_url = f"https://cchdo.ucsd.edu{file['file_path']}"
-
-        with GHAGroup(f"Generating sumfile for: {cruise['expocode']}"):
-            with NamedTemporaryFile() as tf:
-                logger.info(f"Loading {file_url}")
-                tf.write(s.get(file_url).content)
-                df = xr.load_dataset(tf.name, engine="netcdf4", decode_timedelta=False)
-                sumfile = df.cchdo.to_sum()
-                logger.info(
-                    f"Generated sumfile: \n {sumfile.decode('utf8')[:1000]}[...]"
-                )
-
-            submission = make_cchdo_file_record(
-                sumfile, f"{cruise['expocode']}su.txt", cf_file
-            )
-            if (file := file_by_hash.get(submission["file_hash"])) is not None:
-                id_ = file["id"]
-                patch = [
-                    {"op": "replace", "path": "/role", "value": "dataset"},
-                    {"op": "replace", "path": "/data_format", "value": "woce"},
-                    {"op": "replace", "path": "/data_format", "value": "woce"},
-                    {"op": "replace", "path": "/data_type", "value": "summary"},
-                    {"op": "replace", "path": "/file_type", "value": "text/plain"},
-                    {
-                        "op": "replace",
-                        "path": "/file_name",
-                        "value": submission["file_name"],
-                    },
-                ]
-                r = s.post(f"https://cchdo.ucsd.edu/api/v1/file/{id_}")
-                if not r.ok:
-                    logger.critical(f"Could not reactivate file {id_}")
-                    exit(1)
-                r = s.patch(f"https://cchdo.ucsd.edu/api/v1/file/{id_}", json=patch)
-                if not r.ok:
-                    logger.critical(f"Could not patch file {id_}")
-                    exit(1)
-
-            else:
-                r = s.post("https://cchdo.ucsd.edu/api/v1/file", json=submission)
-
-                if not r.ok:
-                    logger.critical("Could not create sumfile")
-                    exit(1)
-
-                id_ = r.json()["message"].split("/")[-1]
-
-            attach = s.post(
-                f"https://cchdo.ucsd.edu/api/v1/cruise/{cruise['id']}/files/{id_}"
+        async def merge(old_id=old_id):
+            r = await api.patch(
+                f"/api/v1/file/{old_id}",
+                json=gen_merge_patch(),
             )
+            if not r.ok:
+                logger.critical(f"Could not merge old sumfile {old_id}")
+            return r.ok
 
-            if not attach.ok:
-                logger.critical("Error patching cruise")
-                exit(1)
+        if not await journal.step(f"merge:{old_id}", merge):
+            return False
+    return True
 
-            logger.info(
-                f"Cruise {cruise['expocode']} updated with sumfile from {cf_file['file_path']}"
-            )
 
-    if len(cannot_do) == len(cruises_no_sum):
+def report_cannot_do(work, cannot_do):
+    if len(work) == 0:
         logger.info("No sumfiles were generated")
 
     if len(cannot_do) > 0:
         with GHAGroup("Cruises where a sumfile could not be generated"):
             logger.info(f"Could not generate sumfile for {len(cannot_do)} cruises:")
-            logger.info(cannot_do)
+            logger.info("%s", cannot_do)
+
+
+def cruise_add_sumfile_from_cf(shard=None, shard_by="expocode", time_budget=None):
+    """Generate and upload the missing sumfiles, returns the deferred expocodes"""
+    scheduler = Scheduler(time_budget)
+    state = RunState()
+    journal = Journal("sumfile", shard=shard)
+    if len(journal.unfinished()) > 0:
+        # the changes the earlier run did make have to be seen
+        metadata.invalidate()
+        with GHAGroup("Resume unfinished sumfile uploads"):
+            resume_unfinished(journal, load_catalogue(s), state)
+            metadata.invalidate()
+
+    with GHAGroup("Load Cruise and File Metadata"):
+        logger.info("Loading Cruise and File information")
+        catalogue = load_catalogue(s)
+
+        work, cannot_do = plan_sumfiles(catalogue, state)
+        if shard is not None:
+            work = select_shard(
+                work,
+                shard,
+                expocode=lambda w: w[0]["expocode"],
+                size=lambda w: w[1].get("file_size") or 0,
+                by=shard_by,
+            )
+            logger.info(f"{len(work)} cruises are in {describe(shard)}")
+        work = newest_first(work, lambda w: w[1])
+
+    # uploads overlap with the next cruises, stop at the first failure seen
+    uploads = []
+    failed = False
+    try:
+        for cruise, cf_file in work:
+            if any(f.done() and not succeeded(f) for f in uploads):
+                break
+            expocode = cruise["expocode"]
+            with scheduler.run(expocode, cf_size(cf_file)) as slot:
+                if not slot:
+                    continue
+                with GHAGroup(f"Generating sumfile for: {expocode}", "cruise", expocode):
+                    try:
+                        df = load_cf(cf_cache.fetch(s, cf_file), tasks=["summary"])
+                        uploads.append(
+                            slot.until(
+                                add_sumfile(
+                                    cruise, cf_file, df, catalogue, state, journal
+                                )
+                            )
+                        )
+                    except Exception:
+                        logger.exception(f"Could not generate sumfile for {expocode}")
+                        cannot_do.append(expocode)
+                        failed = True
+    finally:
+        # the submitted uploads are finished whatever happened
+        api_for(s).wait()
+
+    journal.compact()
+    scheduler.report()
+    failed = failed or not all(succeeded(f) for f in uploads)
+    if failed or len(work) > 0:
+        metadata.invalidate()
+        state.save()
+
+    report_cannot_do(work, cannot_do)
+    if failed:
+        exit(1)
+    return scheduler.deferred
 
 
 if __name__ == "__main__":
-    cruise_add_sumfile_from_cf()
+    close_install_group()
+    parser = argparse.ArgumentParser()
+    add_shard_arguments(parser)
+    add_schedule_arguments(parser, memory=False)
+    args = parser.parse_args()
+    with run_report("sumfile", shard=args.shard) as outcome:
+        outcome["deferred"] = cruise_add_sumfile_from_cf(
+            shard=args.shard, shard_by=args.shard_by, time_budget=args.time_budget
+        )
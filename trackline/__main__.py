@@ -6,88 +6,206 @@
 #     "rich",
 # ]
 # ///
-from tempfile import NamedTemporaryFile
+import argparse
 import logging
+from collections import Counter
+from concurrent.futures import Future
+import sys
+from pathlib import Path
 
-import xarray as xr
-from rich.logging import RichHandler
-
-import cchdo.hydro.accessors  # noqa
 from cchdo.auth.session import session as s
 
-logger = logging.getLogger(__name__)
-
-FORMAT = "%(message)s"
-logging.basicConfig(
-    level="NOTSET", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from robots_common import metadata  # noqa: E402
+from robots_common.api import api_for  # noqa: E402
+from robots_common.catalogue import load_catalogue  # noqa: E402
+from robots_common.cf_cache import cf_cache  # noqa: E402
+from robots_common.datasets import load_cf  # noqa: E402
+from robots_common.gha import GHAGroup  # noqa: E402
+from robots_common.instrument import recorder, run_report  # noqa: E402
+from robots_common.logs import setup_logging  # noqa: E402
+from robots_common.shard import add_shard_arguments, describe, select_shard  # noqa: E402
+from robots_common.state import RunState  # noqa: E402
+from robots_common.track import (  # noqa: E402
+    DEFAULT_MAX_VERTICES,
+    DEFAULT_TOLERANCE,
+    simplify_track,
+    track_digest,
 )
 
+logger = logging.getLogger(__name__)
 
-def has_no_track(cruise) -> bool:
-    return cruise["geometry"]["track"] == {}
-
-
-def is_cf_netcdf_dataset(file) -> bool:
-    is_cf = file["data_format"] == "cf_netcdf"
-    is_dataset = file["role"] == "dataset"
-    return is_cf and is_dataset
+setup_logging(level="NOTSET")
 
+# vertices before and after simplification over the run
+vertex_counts = Counter()
 
-def cruise_add_cruise_track_from_cf():
-    logger.info("Loading Cruise and File information")
-    cruises = s.get("https://cchdo.ucsd.edu/api/v1/cruise/all").json()
-    files = s.get("https://cchdo.ucsd.edu/api/v1/file/all").json()
 
-    file_by_id = {file["id"]: file for file in files}
+def has_no_track(cruise) -> bool:
+    return cruise["geometry"]["track"] == {}
 
-    cruises_no_track = list(filter(has_no_track, cruises))
-    logger.info(f"{len(cruises_no_track)} of {len(cruises)} cruises have no trackline")
 
+def plan_tracks(catalogue, state):
+    """The (cruise, cf_file) pairs to make tracks for and the cruises that cannot have one
+
+    Besides cruises without a track this includes cruises whose track was made
+    by this robot from a CF file that has since changed, as long as it has not
+    been edited since.
+    """
+    cruises_no_track = []
+    cruises_outdated = []
+    for cruise in catalogue.cruises:
+        if has_no_track(cruise):
+            cruises_no_track.append(cruise)
+        elif state.source_changed(
+            "trackline", cruise["expocode"], catalogue.cf_file(cruise)
+        ) and state.made("trackline", cruise["expocode"]) == track_digest(
+            cruise["geometry"]["track"]
+        ):
+            cruises_outdated.append(cruise)
+    logger.info(
+        f"{len(cruises_no_track)} of {len(catalogue.cruises)} cruises have no trackline"
+    )
+    logger.info(f"{len(cruises_outdated)} cruises have a trackline from an old CF file")
+
+    work = []
     cannot_do = []
-    for cruise in cruises_no_track:
-        cf_file = None
-        for file_id in cruise["files"]:
-            try:
-                file = file_by_id[file_id]
-            except KeyError:
-                continue
-
-            if not is_cf_netcdf_dataset(file):
-                continue
-
-            cf_file = file
-            break
-
-        if cf_file is None:
+    for cruise in [*cruises_no_track, *cruises_outdated]:
+        if (cf_file := catalogue.cf_file(cruise)) is None:
             cannot_do.append(cruise)
             continue
-
-        file_url = f"https://cchdo.ucsd.edu{file['file_path']}"
-
-        with NamedTemporaryFile() as tf:
-            logger.info(f"Loading {file_url}")
-            tf.write(s.get(file_url).content)
-            df = xr.load_dataset(tf.name, engine="netcdf4", decode_timedelta=False)
-            track = df.cchdo.track
-
-        patch = [{"op": "replace", "path": "/geometry/track", "value": track}]
-
-        logger.info(f"Generated patch {patch}")
-
-        response = s.patch(
-            f"https://cchdo.ucsd.edu/api/v1/cruise/{cruise['id']}", json=patch
+        work.append((cruise, cf_file))
+    return work, cannot_do
+
+
+def add_track(
+    cruise,
+    cf_file,
+    df,
+    state,
+    tolerance=DEFAULT_TOLERANCE,
+    max_vertices=DEFAULT_MAX_VERTICES,
+) -> Future:
+    """Generate the track for cruise and submit the patch, the future is False if it failed
+
+    The track is simplified if a tolerance (degrees) or max_vertices is given.
+    """
+    with recorder.stage("track") as stage:
+        track = df.cchdo.track
+        before = len(track["coordinates"])
+        track = simplify_track(track, tolerance, max_vertices)
+        after = len(track["coordinates"])
+        stage.update(vertices=before, simplified_vertices=after)
+    vertex_counts.update(before=before, after=after)
+    if after < before:
+        logger.info(f"Simplified track from {before} to {after} vertices")
+
+    patch = [{"op": "replace", "path": "/geometry/track", "value": track}]
+
+    logger.debug("Generated patch %s", patch)
+
+    return api_for(s).submit(
+        patch_track(cruise, cf_file, patch, track_digest(track), state)
+    )
+
+
+async def patch_track(cruise, cf_file, patch, digest, state) -> bool:
+    with recorder.stage("upload"):
+        try:
+            response = await api_for(s).patch(
+                f"/api/v1/cruise/{cruise['id']}", json=patch, idempotent=True
+            )
+        except Exception as err:
+            logger.critical(f"Error patching cruise: {err}")
+            return False
+
+    if not response.ok:
+        logger.critical("Error patching cruise")
+        return False
+
+    logger.info(
+        f"Cruise {cruise['expocode']} updated with trackline from {cf_file['file_path']}"
+    )
+    state.record("trackline", cruise["expocode"], cf_file, made=digest)
+    return True
+
+
+def report_simplification():
+    if vertex_counts["after"] < vertex_counts["before"]:
+        logger.info(
+            f"Simplified tracks to {vertex_counts['after']} of {vertex_counts['before']} vertices "
+            f"({vertex_counts['after'] / vertex_counts['before']:.1%})"
         )
 
-        if not response.ok:
-            logger.critical("Error patching cruise")
 
-        logger.info(
-            f"Cruise {cruise['expocode']} updated with trackline from {file['file_path']}"
+def cruise_add_cruise_track_from_cf(
+    tolerance=DEFAULT_TOLERANCE,
+    max_vertices=DEFAULT_MAX_VERTICES,
+    shard=None,
+    shard_by="expocode",
+):
+    logger.info("Loading Cruise and File information")
+    catalogue = load_catalogue(s)
+    state = RunState()
+
+    work, cannot_do = plan_tracks(catalogue, state)
+    if shard is not None:
+        work = select_shard(
+            work,
+            shard,
+            expocode=lambda w: w[0]["expocode"],
+            size=lambda w: w[1].get("file_size") or 0,
+            by=shard_by,
         )
+        logger.info(f"{len(work)} cruises are in {describe(shard)}")
+
+    try:
+        for cruise, cf_file in work:
+            with GHAGroup(
+                f"Adding trackline for: {cruise['expocode']}", "cruise", cruise["expocode"]
+            ):
+                try:
+                    df = load_cf(cf_cache.fetch(s, cf_file), tasks=["track"])
+                    add_track(cruise, cf_file, df, state, tolerance, max_vertices)
+                except Exception:
+                    logger.exception(f"Could not generate track for {cruise['expocode']}")
+                    cannot_do.append(cruise)
+    finally:
+        # the submitted patches are finished whatever happened
+        api_for(s).wait()
+    report_simplification()
+    if len(work) > 0:
+        metadata.invalidate()
+        state.save()
 
     if len(cannot_do) > 0:
         logger.info(f"Could not generate track for {len(cannot_do)} cruises")
 
 
+def add_simplify_arguments(parser):
+    parser.add_argument(
+        "--track-tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="simplify tracks, dropping vertices within this many degrees of the line",
+    )
+    parser.add_argument(
+        "--track-max-vertices",
+        type=int,
+        default=DEFAULT_MAX_VERTICES,
+        help="simplify tracks to at most this many vertices",
+    )
+
+
 if __name__ == "__main__":
-    cruise_add_cruise_track_from_cf()
+    parser = argparse.ArgumentParser()
+    add_simplify_arguments(parser)
+    add_shard_arguments(parser)
+    args = parser.parse_args()
+    with run_report("trackline", shard=args.shard):
+        cruise_add_cruise_track_from_cf(
+            args.track_tolerance,
+            args.track_max_vertices,
+            shard=args.shard,
+            shard_by=args.shard_by,
+        )